@@ -1,9 +1,15 @@
 import sys
 import argparse
+from contextlib import nullcontext
 
-from src.module import darkprocessing, flatprocessing
+from src.module import darkprocessing, flatprocessing, pipeline
 from src.util import helperfunc, outputimg
 from src.util.Fits import Fits
+from src.util.HeaderIndex import HeaderIndex
+from src.util.CalibrationCache import CalibrationCache
+from src.util.FitsWriter import FitsWriter
+from src.util.PreviewRenderer import PreviewRenderer
+from src.util.Precision import Precision
 from src.util.Constant import Constant
 
 # TODO: Consider using logging to better organize the execution and any errors arising.
@@ -29,6 +35,18 @@ def main():
     parser.add_argument("-dt", "--dark_type", help="filter dark frames from drk_path", action="store_true")
     parser.add_argument("-ft", "--flat_type", help="filter flat frames from flt_path", action="store_true")
     parser.add_argument("-w", "--write", help="write every FITS file created to disk", action="store_true")
+    parser.add_argument("-c", "--cache", help="reuse master dark/flat frames cached from earlier runs on the same frames", action="store_true")
+    parser.add_argument("-s", "--superpixel", help="extract half-resolution channels by collapsing each 2x2 Bayer cell instead of interpolating", action="store_true")
+    parser.add_argument("-r", "--raw", help="apply dark and flat correction to the Bayer mosaic before extracting channels", action="store_true")
+    parser.add_argument("-b", "--balance", help="color balance calibrated science frames, matching red and blue to the mean and spread of green", action="store_true")
+    parser.add_argument("-j", "--jobs", help="number of worker processes calibrating science frames", type=int, default=1)
+    parser.add_argument("-i", "--index", help="look up frame headers in the on-disk header index instead of re-reading them", action="store_true")
+    parser.add_argument("-p", "--precision", help="floating point type frames are processed in", choices=list(Precision.WORKING_TYPES), default="float64")
+    parser.add_argument("-l", "--layout", help="how calibrated frames are written: one file per channel, or one file per frame with a FITS extension per channel (mef) or a 3-plane cube", choices=["channels", "mef", "cube"], default="channels")
+    parser.add_argument("-z", "--compress", help="tile compression of one-file-per-frame outputs", choices=["RICE_1", "GZIP_1", "GZIP_2"], default=None)
+    parser.add_argument("-pv", "--preview", help="render a preview image of every calibrated science frame in this format", choices=["png", "jpg", "webp"], default=None)
+    parser.add_argument("-pl", "--preview_level", help="PNG compression level (0-9) or JPEG/WebP quality (1-100) of previews", type=int, default=None)
+    parser.add_argument("-st", "--storage", help="type FITS files are written with, default keeps the processing type", choices=Precision.STORAGE_TYPES, default=None)
 
     args = parser.parse_args()
 
@@ -39,6 +57,8 @@ def main():
     target_path = args.trg_path.replace("\\", "/")
     boost = 5   # add option to set this later
 
+    Precision.configure(args.precision, args.storage)
+
     # flags
     dt = "N/A"
     ft = "N/A"
@@ -51,61 +71,110 @@ def main():
         ft = Constant.HeaderObj.FLAT_IMG
         print(f"filtering flat frames from directory {args.flt_path}")
 
-    dark_frame_list = Fits.batchload(dark_path, dt)
-    flat_frame_list = Fits.batchload(flat_path, ft)
-    sci_img_list = Fits.batchload(target_path)
+    index = HeaderIndex() if args.index else None
+
+    # lazy loading keeps file handles and data out of memory until a frame is actually used
+    dark_frame_list = Fits.batchload(dark_path, dt, lazy=True, index=index)
+    flat_frame_list = Fits.batchload(flat_path, ft, lazy=True, index=index)
+    sci_img_list = Fits.batchload(target_path, lazy=True, index=index)
 
     # BAYER PATTERN MUST MATCH!!
-    darkpat = dark_frame_list[0].bayerpat()
-    flatpat = flat_frame_list[0].bayerpat()
-    scipat = sci_img_list[0].bayerpat()
+    if index is not None:
+        darkpat = index.get(dark_frame_list[0].path)[Constant.HeaderObj.BAYER_KEY]
+        flatpat = index.get(flat_frame_list[0].path)[Constant.HeaderObj.BAYER_KEY]
+        scipat = index.get(sci_img_list[0].path)[Constant.HeaderObj.BAYER_KEY]
+        index.close()
+    else:
+        darkpat = dark_frame_list[0].bayerpat()
+        flatpat = flat_frame_list[0].bayerpat()
+        scipat = sci_img_list[0].bayerpat()
+
     bayermatch = darkpat == flatpat and scipat == darkpat
 
     if not bayermatch:
         raise ValueError("Bayer pattern mismatch!")
 
-    # median stack flat and dark frames
-    medStack_dark = darkprocessing.median_stack_fits(dark_frame_list, CONST.DARK_MEDSTACK)
-    medStack_flat = darkprocessing.median_stack_fits(flat_frame_list, CONST.FLAT_MEDSTACK)
-
-    # Green tint is noraml due to more green pixels than the others, fixed in post processing
-    # Still using subtraction per channel cuz it look nice
-    #darkprocessing.subtract_fits(medStack_flat, medStack_dark)
-    #darkprocessing.subtract_fits(sci_img_list, medStack_dark)
-
-    ### pre-process per channel (switch this to above if you want proper/expected result) ###
-    dark_rgb = helperfunc.extract_rgb_from_fits(medStack_dark, Constant.DARK_PATH)
-    flat_rgb = helperfunc.extract_rgb_from_fits(medStack_flat, Constant.FLAT_PATH)
-    
-    for i in range(0,3):
-        darkprocessing.subtract_fits(flat_rgb[i], dark_rgb[i])
-        flatprocessing.normalize_fits(flat_rgb[i])
-    ### --------------------------------------------------------------------------------- ###
-
-    # process science images
-    for i in range(0, len(sci_img_list)):
-        fp = sci_img_list[i].path
-        fn = fp[fp.rfind("/") + 1: len(fp) - 5] # get filename
-
-        sci_img_list[i] = helperfunc.extract_rgb_from_fits(sci_img_list[i], Constant.SCIENCE_PATH) + (fn,) # tuple is now (r, g, b, fn)
-
-        for j in range(0, 3):
-            darkprocessing.subtract_fits(sci_img_list[i][j], dark_rgb[j])   # subtract darks per channel, move to outer loop for raw subtraction
-            flatprocessing.divide_fits(sci_img_list[i][j], flat_rgb[j])
-
-        # outputimg.generate_PNG(sci_img_list[i][3] + "_pre_align.png", sci_img_list[i][0], sci_img_list[i][1], sci_img_list[i][2], boost_factor=boost)
-
-    # write to disk
-    if args.write:
-        medStack_dark.diskwrite()   # write median-stacked dark frame
-        medStack_flat.diskwrite()   # write median-stacked flat frame
-
-        for channel in flat_rgb:
-            channel.diskwrite()     # write dark processed and normalized flat channels
-
-        for i in range(0, len(sci_img_list)):
-            for j in range(0, 3):
-                sci_img_list[i][j].diskwrite()
+    cache = CalibrationCache() if args.cache else None
+    dark_cached = None
+    flat_cached = None
+
+    # masters are cached under a fingerprint of their frames and of how they are built
+    if cache is not None:
+        dark_key = cache.fingerprint(dark_frame_list, master="dark", stack="median", raw=args.raw, superpixel=args.superpixel, precision=Precision.working)
+        flat_key = cache.fingerprint(flat_frame_list, master="flat", stack="median", raw=args.raw, superpixel=args.superpixel, precision=Precision.working, dark=dark_key)
+
+        dark_cached = cache.load(dark_key)
+        flat_cached = cache.load(flat_key)
+
+    # median stack dark frames
+    if dark_cached is not None:
+        medStack_dark, *dark_rgb = dark_cached
+    else:
+        medStack_dark = darkprocessing.median_stack_fits(dark_frame_list, CONST.DARK_MEDSTACK)
+
+        # Green tint is noraml due to more green pixels than the others, fixed in post processing
+        # Per channel subtraction by default cuz it look nice, raw subtraction with --raw
+        dark_rgb = [] if args.raw else list(helperfunc.extract_rgb_from_fits(medStack_dark, Constant.DARK_PATH, args.superpixel))
+
+        if cache is not None:
+            cache.store(dark_key, [medStack_dark] + dark_rgb)
+
+    # median stack flat frames
+    if flat_cached is not None:
+        medStack_flat, *flat_rgb = flat_cached
+    else:
+        medStack_flat = darkprocessing.median_stack_fits(flat_frame_list, CONST.FLAT_MEDSTACK)
+
+        if args.raw:
+            # dark processed and normalized flat mosaic, channels only get extracted from calibrated science frames
+            flat_rgb = [darkprocessing.subtract_fits(medStack_flat, medStack_dark, overwrite=False)]
+            flatprocessing.normalize_bayer_fits(flat_rgb[0])
+        else:
+            flat_rgb = list(helperfunc.extract_rgb_from_fits(medStack_flat, Constant.FLAT_PATH, args.superpixel))
+
+            for i in range(0,3):
+                darkprocessing.subtract_fits(flat_rgb[i], dark_rgb[i])
+                flatprocessing.normalize_fits(flat_rgb[i])
+
+        if cache is not None:
+            cache.store(flat_key, [medStack_flat] + flat_rgb)
+
+    # what the science frames get calibrated with
+    dark_cal = (medStack_dark,) if args.raw else tuple(dark_rgb)
+    flat_cal = tuple(flatprocessing.reciprocal_flat(flat) for flat in flat_rgb)     # precomputed once, frames are multiplied by it
+
+    preview = {"extension": "." + args.preview, "level": args.preview_level, "boost_factor": boost} if args.preview else None
+
+    # write to disk in the background, overlapping with the processing that follows. Leaving the
+    # with block waits for the last writes and raises if any failed, an error drops what is queued
+    with FitsWriter() if args.write else nullcontext() as writer:
+        if args.write:
+            writer.submit(medStack_dark)    # write median-stacked dark frame
+            writer.submit(medStack_flat)    # write median-stacked flat frame
+
+            for channel in flat_rgb:
+                writer.submit(channel)      # write dark processed and normalized flat channels (or mosaic)
+
+        # process science images, one frame at a time so memory does not grow with the number of frames
+        if args.jobs > 1:
+            # workers write their own science channels and previews, nothing is kept here
+            names = pipeline.calibrate_parallel([sci_img.path for sci_img in sci_img_list], dark_cal, flat_cal, args.jobs, write=args.write, superpixel=args.superpixel, raw=args.raw, layout=args.layout, compression=args.compress, preview=preview, balance=args.balance)
+
+            if preview:
+                print(f"{len(names)} previews generated in {Constant.OUTPUT_PATH}")
+        else:
+            # previews are rendered in the background like the writes
+            with PreviewRenderer(**preview) if preview else nullcontext() as renderer:
+                for sci_rgb in pipeline.calibrate_stream(sci_img_list, dark_cal, flat_cal, superpixel=args.superpixel, raw=args.raw, balance=args.balance): # tuple is (r, g, b, fn)
+                    if preview:
+                        renderer.submit(sci_rgb[3] + "_pre_align", sci_rgb[:3])
+
+                    if args.write:
+                        for output in pipeline.frame_outputs(sci_rgb, layout=args.layout, compression=args.compress):
+                            writer.submit(output)
+
+                if preview:
+                    print(f"{len(renderer.close())} previews generated in {Constant.OUTPUT_PATH}")
 
 # run main
 if __name__ == "__main__":
@@ -3,20 +3,97 @@ from concurrent.futures import ThreadPoolExecutor
 
 from src.util.Fits import *
 
+# default amount of memory (in bytes) a stacking strip is allowed to take
+DEFAULT_MEMORY_BUDGET = 512 * 1024 * 1024
+
 def load_fits_data(fits_file):
     """Helper function to get FITS data from an open FITS object."""
     return fits_file.get_data()
 
-def median_stack_fits(fits_files: list[Fits], output_file: str):
+def strip_rows(frame_count: int, width: int, itemsize: int, memory_budget: int=DEFAULT_MEMORY_BUDGET):
+    """
+    Number of image rows per strip so that a strip of every frame fits in the memory budget.
+
+    params
+    ------
+    frame_count: int
+        Number of frames being stacked
+    width: int
+        Width of the frames in pixels
+    itemsize: int
+        Size in bytes of a single pixel value
+    memory_budget: int, optional
+        Approximate amount of memory in bytes a strip is allowed to take
+
+    return
+    ------
+    int
+        Number of rows per strip, at least one
+    """
+
+    # the strip cube is held three times: as read from the files, stacked into one array, and the copy the median partitions
+    strip_bytes = 3 * frame_count * width * itemsize
+    return max(1, memory_budget // strip_bytes)
+
+def select_median(block: np.ndarray):
+    """
+    Median along the first axis of a stack, the same as np.median(block, axis=0) only faster.
+    Like np.median, the median of a pixel with a NaN value in any frame is NaN.
+
+    np.median partitions around both middle ranks at once, which for an even number of frames
+    takes numpy's slow multi-rank path. Partitioning around the upper middle rank alone is
+    enough: the lower middle value is then the largest of the values placed before it.
+
+    params
+    ------
+    block: np.ndarray
+        Stack of frames (frames, ...)
+
+    return
+    ------
+    np.ndarray
+        Median of the stack, float64 for integer input like np.median
+    """
+
+    frames = block.shape[0]
+    middle = frames // 2
+
+    # results are in native byte order (FITS data is big-endian), float64 for integers like np.median
+    dtype = np.float64 if block.dtype.kind in "iub" else block.dtype.newbyteorder("=")
+
+    partitioned = np.partition(block, middle, axis=0)
+    upper = partitioned[middle]
+
+    if frames % 2:
+        median = upper.astype(dtype)
+    else:
+        median = partitioned[:middle].max(axis=0).astype(dtype)
+        median += upper
+        median /= 2
+
+    # partition sorts NaN last and max skips past it, set the pixels np.median would give NaN
+    if block.dtype.kind == "f":
+        median[np.isnan(block).any(axis=0)] = np.nan
+
+    return median
+
+def median_stack_fits(fits_files: list[Fits], output_file: str, memory_budget: int=DEFAULT_MEMORY_BUDGET):
     """
     Create a median-stacked image from a list of FITS images.
 
+    The stack is computed in horizontal strips of rows, so only one strip of every frame
+    is held in memory at a time. Frames that are still on disk are read strip by strip
+    through memory-mapped access instead of being loaded whole. The result is the same
+    as taking the median over the full cube, computed with select_median.
+
     params
     ------
     fits_file: list[Fits]
         List of FITS objects to be median-stacked
     output_file: str
         Path to where the output is going to be written
+    memory_budget: int, optional
+        Approximate amount of memory in bytes the stacking strips are allowed to take
 
     return
     ------
@@ -25,34 +102,136 @@ def median_stack_fits(fits_files: list[Fits], output_file: str):
     """
 
     # Get a copy of header to retain information from original FITS
-    header_copy = fits_files[0].hdul[0].header
+    header_copy = fits_files[0].header
 
-    # List to store data arrays from FITS files
-    image_data = []
+    height, width = fits_files[0].shape()
+    itemsize = fits_files[0].get_rows(0, 1).dtype.itemsize
+    rows = strip_rows(len(fits_files), width, itemsize, memory_budget)
 
-    # Read each FITS file and append the data to the list
-    for file in fits_files:
-        image_data.append(file.get_data())
+    stacked_median = None
 
-    # tried threading, kek tai anjing
-    '''
-    with ThreadPoolExecutor() as executor:
-        image_data = list(executor.map(load_fits_data, fits_files))
+    # every frame is read once per strip, keep all of them open for the whole stack
+    with Fits.pool.working_set(len(fits_files)):
+        for start in range(0, height, rows):
+            stop = min(start + rows, height)
 
-    # Stack the images and compute the median along the stack axis
-    image_data = np.stack(image_data, axis=0)
-    '''
+            # Collect the same strip from every frame and compute the median along the stack axis
+            image_data = [file.get_rows(start, stop) for file in fits_files]
+            strip_median = select_median(np.array(image_data))
 
-    # Stack the images and compute the median along the stack axis
-    stacked_median = np.median(np.array(image_data), axis=0)
+            if stacked_median is None:
+                # medians of integer frames are whole or half values, exact in either working type
+                dtype = Precision.working if image_data[0].dtype.kind in "iu" else strip_median.dtype
+                stacked_median = np.empty((height, width), dtype=dtype)
+            stacked_median[start:stop] = strip_median
 
     # Return new Fits object with the calculated data
     return Fits.filecreate(output_file, stacked_median, header_copy)
 
 
-def mean_stack_fits(fits_files: list[Fits], output_file: str):
+def sigma_clip_block(block: np.ndarray, kappa: float, iterations: int):
     """
-    Create a mean-stacked image from a list of FITS images
+    Sigma-clipped mean along the first axis of a small stack, see sigma_clip_stack.
+
+    params
+    ------
+    block: np.ndarray
+        3D array (frames, rows, columns) in working precision
+    kappa: float
+        Rejection threshold in standard deviations
+    iterations: int
+        Maximum number of clipping passes
+
+    return
+    ------
+    np.ndarray
+        2D array (rows, columns) of the clipped mean
+    """
+
+    keep = np.ones(block.shape, dtype=bool)
+    deviation = np.empty_like(block)
+
+    # first pass has nothing masked yet
+    count = np.full(block.shape[1:], block.shape[0], dtype=block.dtype)
+    mean = block.sum(axis=0) / count
+
+    for _ in range(iterations):
+        # squared deviations, their masked mean is the variance of the values still kept
+        np.subtract(block, mean, out=deviation)
+        np.square(deviation, out=deviation)
+        variance = np.sum(deviation, axis=0, where=keep)
+        np.divide(variance, count, out=variance, where=count > 0)
+
+        # |x - mean| <= kappa * std, compared in squares to skip the abs and sqrt passes
+        inside = deviation <= variance * kappa ** 2
+        inside &= keep
+
+        # nothing left to clip, the mean above is final
+        if np.array_equal(inside, keep):
+            break
+        keep = inside
+
+        count = keep.sum(axis=0, dtype=block.dtype)
+        total = np.sum(block, axis=0, where=keep)
+        mean = np.divide(total, count, out=np.zeros_like(total), where=count > 0)
+
+    return mean
+
+def sigma_clip_stack(image_data: list[np.ndarray | Fits], kappa: float=1.5, iterations: int=1, dtype: type=None, memory_budget: int=DEFAULT_MEMORY_BUDGET):
+    """
+    Sigma-clipped mean along the stack axis of a list of equally sized images.
+
+    Pixels further than kappa standard deviations from the per-pixel mean are rejected and
+    the mean of the remaining values is returned. Clipping runs on strips of rows copied
+    into working precision, using masked sums and counts, so besides the input frames
+    the only allocations are bounded by the strip size.
+
+    params
+    ------
+    image_data: list[np.ndarray | Fits]
+        List of 2D image arrays of the same shape, Fits objects are read strip by strip
+    kappa: float, optional
+        Rejection threshold in standard deviations, default to 1.5
+    iterations: int, optional
+        Maximum number of clipping passes, clipping stops early once no pixel is rejected
+    dtype: type, optional
+        Floating point type of the stack and the accumulators, default to Precision.working
+    memory_budget: int, optional
+        Approximate amount of memory in bytes the temporaries of a strip are allowed to take,
+        default to DEFAULT_MEMORY_BUDGET like median_stack_fits
+
+    return
+    ------
+    np.ndarray
+        2D array of the clipped mean
+    """
+
+    def read_rows(frame, start, stop):
+        if isinstance(frame, Fits):
+            return frame.get_rows(start, stop)
+        return frame[start:stop]
+
+    dtype = Precision.dtype(dtype)
+    first = image_data[0]
+    height, width = first.shape() if isinstance(first, Fits) else np.shape(first)
+    rows = strip_rows(len(image_data), width, np.dtype(dtype).itemsize, memory_budget)
+
+    clipped_mean = np.empty((height, width), dtype=dtype)
+
+    # every frame is read once per strip, keep all of them open for the whole stack
+    with Fits.pool.working_set(len(image_data)):
+        for start in range(0, height, rows):
+            stop = min(start + rows, height)
+
+            # the same strip of every frame, in working precision
+            block = np.array([read_rows(frame, start, stop) for frame in image_data], dtype=dtype)
+            clipped_mean[start:stop] = sigma_clip_block(block, kappa, iterations)
+
+    return clipped_mean
+
+def mean_stack_fits(fits_files: list[Fits], output_file: str, kappa: float=1.5, iterations: int=1, dtype: type=None):
+    """
+    Create a mean-stacked image from a list of FITS images, rejecting outliers with sigma clipping
 
     params
     ------
@@ -60,28 +239,22 @@ def mean_stack_fits(fits_files: list[Fits], output_file: str):
         List of FITS objects to be median-stacked
     output_file: str
         Path to where the output is going to be written
+    kappa: float, optional
+        Rejection threshold in standard deviations, default to 1.5 (formula taken from Swift team's code)
+    iterations: int, optional
+        Maximum number of clipping passes, default to a single pass
+    dtype: type, optional
+        Floating point type used for the stack and accumulation, default to Precision.working
 
     return
     ------
     Fits object
     """
 
-    # List to store data arrays from FITS files
-    image_data = []
     # Get a copy of header to retain information from original FITS
-    header_copy = fits_files[0].hdul[0].header
-
-    # Read each FITS file and append the data to the list
-    for file in fits_files:
-        image_data.append(file.get_data())
-
-    stdev = np.std(np.array(image_data), axis=0)
-    mean = np.mean(np.array(image_data), axis=0)
+    header_copy = fits_files[0].header
 
-    # Create a mask to filter out outliers, and average the values that are left
-    mask = np.abs(image_data - mean) <= 1.5 * stdev  # formula taken from Swift team's code
-    masked_data = np.where(mask, image_data, np.nan)  # this was what Elaine meant by using mask
-    mean_masked = np.nanmean(masked_data, axis=0)
+    mean_masked = sigma_clip_stack(fits_files, kappa, iterations, dtype)
 
     return Fits.filecreate(output_file, mean_masked, header_copy)
 
@@ -118,14 +291,14 @@ def subtract_fits(target_img: Fits, dark_img: Fits, overwrite: bool=True, output
         raise BaseException(
             f"Different image dimensons!\ndark image dimension: {dark_dimension}\ntarget image dimension: {target_dimension}")
 
-    target_data = np.subtract(target_data, dark_data)
+    target_data = np.subtract(target_data, dark_data, dtype=Precision.working)
     target_data = np.where(target_data < 0, 0, target_data) # for some reason this fixes the white-washing
 
     if overwrite:
         target_img.set_data(target_data)
     else:
         # Get a copy of header to retain information from original FITS
-        header_copy = target_img.hdul[0].header
+        header_copy = target_img.header
 
         # if output path is specified, do as so
         if (output_path):
@@ -3,25 +3,49 @@ import cv2
 from scipy.ndimage import convolve
 
 from src.util.Fits import *
-from src.util import helperfunc
+from src.util import helperfunc, stats
 
 def normalize_fits(fits: Fits, overwrite: bool=True):
     """
-    Normalize the master flat by dividing it by its median.
+    Normalize the master flat by dividing it by its median, estimated from a sample of the flat (stats.median).
     """
     
-    data = fits.get_data()
+    data = np.asarray(fits.get_data(), dtype=Precision.working)
 
-    median_data = np.median(data)
+    median_data = stats.median(data)
 
     normalized_data = data / median_data
 
     if overwrite:
         fits.set_data(normalized_data)
     else:
-        path = fits.path[:len(path)-5] + "_normalized.fits"
+        path = fits.path[:len(fits.path)-5] + "_normalized.fits"
         return Fits.filecreate(path, normalized_data)
 
+def normalize_bayer_fits(fits: Fits, overwrite: bool=True):
+    """
+    Normalize a raw (not demosaiced) master flat, dividing the pixels of each color by that color's median.
+
+    This is the mosaic counterpart of running normalize_fits on each color channel, it keeps 
+    the color balance of the flat out of the correction.
+    """
+
+    data = np.array(fits.get_data(), dtype=Precision.working)
+
+    for offsets in bayer_sites(fits.bayerpat()).values():
+        # medians estimated from samples of the sites of each color (stats.sample)
+        sample_size = stats.DEFAULT_SAMPLE_SIZE // len(offsets)
+        median_data = np.nanmedian(np.concatenate([stats.sample(data[y::2, x::2], sample_size) for y, x in offsets]))
+
+        for y, x in offsets:
+            data[y::2, x::2] /= median_data
+
+    if overwrite:
+        fits.set_data(data)
+    else:
+        path = fits.path[:len(fits.path)-5] + "_normalized.fits"
+        return Fits.filecreate(path, data, fits.header)
+
 def divide_fits(target_img: Fits, flat_img: Fits, overwrite: bool=True, output_path: str=None):
     """
     Divide target FITS image by flat FITS image
@@ -43,7 +67,7 @@ def divide_fits(target_img: Fits, flat_img: Fits, overwrite: bool=True, output_p
         new Fits object of resulting division, or None when overwrite flag set to true
     """
 
-    flat_data = np.array(flat_img.get_data())
+    flat_data = np.array(flat_img.get_data(), dtype=Precision.working)
     target_data = np.array(target_img.get_data())
 
     flat_dimension = (flat_data.shape[0], flat_data.shape[1])
@@ -57,7 +81,7 @@ def divide_fits(target_img: Fits, flat_img: Fits, overwrite: bool=True, output_p
     flat_data[flat_data == 0] = np.nan
 
     # Perform the division
-    divided_data = np.divide(target_data, flat_data)
+    divided_data = np.divide(target_data, flat_data, dtype=Precision.working)
 
     # Replace NaNs resulting from division by zero with zeros
     divided_data = np.nan_to_num(divided_data)
@@ -75,7 +99,81 @@ def divide_fits(target_img: Fits, flat_img: Fits, overwrite: bool=True, output_p
 
         return Fits.filecreate(new_path, divided_data)
 
-def sort_flats_by_color(fits_files: list[Fits]):
+def reciprocal_flat(flat_img: Fits, dtype: type=None):
+    """
+    Precompute the safe reciprocal of a master flat, so correcting a frame is a multiplication.
+
+    Zero pixels of the flat get a reciprocal of zero, which zeroes the corrected pixel like 
+    divide_fits does.
+
+    params
+    ------
+    flat_img: Fits
+        Fits object of the (normalized) master flat
+    dtype: type, optional
+        Floating point type of the reciprocal, which is also the type of calibrated frames,
+        default to Precision.working
+
+    return
+    ------
+    Fits
+        New Fits object holding 1 / flat, named with "_reciprocal" at the end of the flat's name
+    """
+
+    flat_data = np.asarray(flat_img.get_data())
+
+    reciprocal = np.zeros(flat_data.shape, dtype=Precision.dtype(dtype))
+    np.divide(1, flat_data, out=reciprocal, where=flat_data != 0)
+
+    return Fits.filecreate(flat_img.path[:len(flat_img.path)-5] + "_reciprocal.fits", reciprocal, flat_img.header)
+
+def calibrate_fits(target_img: Fits, dark_img: Fits, flat_reciprocal: Fits, out: np.ndarray=None, chunk_bytes: int=1024 * 1024):
+    """
+    Dark and flat correct target FITS image in a single fused pass, max(target - dark, 0) / flat.
+
+    Same result as subtract_fits followed by divide_fits, without their copies and temporaries: 
+    every step writes into the output buffer, one strip of rows at a time so each strip stays 
+    in cache across the three steps.
+
+    params
+    ------
+    target_img: Fits
+        Fits object of target image, its data is replaced with the calibrated data
+    dark_img: Fits
+        Fits object of dark image
+    flat_reciprocal: Fits
+        Reciprocal of the flat image, from reciprocal_flat
+    out: np.ndarray, optional
+        Floating point buffer the result is written to, may be the target data itself.
+        Allocated with the type of the reciprocal flat when not given
+    chunk_bytes: int, optional
+        Approximate size in bytes of an output strip
+    """
+
+    target_data = target_img.get_data()
+    dark_data = dark_img.get_data()
+    reciprocal = flat_reciprocal.get_data()
+
+    # ensure same image dimensions
+    if not (target_data.shape == dark_data.shape == reciprocal.shape):
+        raise ValueError(
+            f"Different image dimensions!\ntarget image dimension: {target_data.shape}\ndark image dimension: {dark_data.shape}\nflat image dimension: {reciprocal.shape}")
+
+    if out is None:
+        out = np.empty(target_data.shape, dtype=reciprocal.dtype)
+
+    rows = max(1, chunk_bytes // (out.itemsize * out.shape[1]))
+
+    for start in range(0, out.shape[0], rows):
+        strip = out[start:start + rows]
+
+        np.subtract(target_data[start:start + rows], dark_data[start:start + rows], out=strip)
+        np.maximum(strip, 0, out=strip)
+        np.multiply(strip, reciprocal[start:start + rows], out=strip)
+
+    target_img.set_data(out)
+
+def sort_flats_by_color(fits_files: list[Fits], index=None):
     """
     Sort flat images into separate lists for Red, Green, and Blue flats based on their FITS header information.
     
@@ -83,6 +181,8 @@ def sort_flats_by_color(fits_files: list[Fits]):
     ------
     fits_files: list[Fits]
         List of FITS objects to be sorted by color channel.
+    index: HeaderIndex, optional
+        Header index to look the filters up in instead of reading every header
     
     return
     ------
@@ -94,12 +194,13 @@ def sort_flats_by_color(fits_files: list[Fits]):
     blue_flats = []
     
     for fits_file in fits_files:
-        header = fits_file.hdul[0].header  # Access the header of the primary HDU
-        print(header)
         # Check for the 'FILTER' keyword in the header to determine the color
-        if 'FILTER' in header:
-            filter_name = header['FILTER']  # Get the filter value directly from the header
-            print(filter_name)
+        if index is not None:
+            filter_name = index.get(fits_file.path)[Constant.HeaderObj.FILTER_KEY]
+        else:
+            filter_name = fits_file.header.get(Constant.HeaderObj.FILTER_KEY)  # Access the header of the primary HDU
+
+        if filter_name is not None:
             if filter_name.lower() == 'r':  
                 red_flats.append(fits_file)
             elif filter_name.lower() == 'g':
@@ -173,6 +274,143 @@ def extract_rgb_optimized(float_data, bayer_pat):
     return red_image, green_image, blue_image
 
 
+def bayer_sites(bayer_pat: str):
+    """
+    Positions of each color within the 2x2 cell of a Bayer pattern.
+
+    params
+    ------
+    bayer_pat: str
+        Bayer pattern, one of 'RGGB', 'BGGR', 'GRBG', 'GBRG'
+
+    return
+    ------
+    dict
+        Maps 'R', 'G' and 'B' to the list of (row, column) offsets of that color in the cell
+    """
+
+    if bayer_pat not in ('RGGB', 'BGGR', 'GRBG', 'GBRG'):
+        raise ValueError(f"Invalid Bayer Pattern: {bayer_pat}")
+
+    sites = {'R': [], 'G': [], 'B': []}
+    for i, color in enumerate(bayer_pat):
+        sites[color].append((i // 2, i % 2))
+
+    return sites
+
+def demosaic_bilinear(data: np.ndarray, bayer_pat: str, dtype: type=None):
+    """
+    Bilinear demosaic of a Bayer mosaic into full-size red, green and blue channels.
+
+    Known pixels are copied as-is and only the missing ones are interpolated, working on 
+    the four 2x2 sub-lattices with strided slices instead of full-image convolutions:
+    green from its 4 direct neighbors, red/blue on green pixels from their 2 horizontal or 
+    vertical neighbors, red/blue on blue/red pixels from their 4 diagonal neighbors. 
+    Borders are mirrored, which keeps the pattern of the mosaic intact.
+
+    params
+    ------
+    data: np.ndarray
+        2D array of the raw mosaic
+    bayer_pat: str
+        Bayer pattern, one of 'RGGB', 'BGGR', 'GRBG', 'GBRG'
+    dtype: type, optional
+        Floating point type of the channels, default to Precision.working
+
+    return
+    ------
+    tuple(np.ndarray, np.ndarray, np.ndarray)
+        Red, green and blue channels with the shape of data
+    """
+
+    sites = bayer_sites(bayer_pat)
+    height, width = data.shape
+    dtype = Precision.dtype(dtype)
+
+    # one pixel of mirrored border so every site has all its neighbors
+    padded = np.pad(np.asarray(data, dtype=dtype), 1, mode='reflect')
+
+    def neighbor(y0, x0, dy, dx):
+        # view of the pixels at offset (dy, dx) from every site of the sub-lattice starting at (y0, x0)
+        rows = (height - y0 + 1) // 2
+        cols = (width - x0 + 1) // 2
+        return padded[1 + y0 + dy:1 + y0 + dy + 2 * rows:2, 1 + x0 + dx:1 + x0 + dx + 2 * cols:2]
+
+    def average(out, y0, x0, offsets):
+        np.add(neighbor(y0, x0, *offsets[0]), neighbor(y0, x0, *offsets[1]), out=out)
+        for offset in offsets[2:]:
+            np.add(out, neighbor(y0, x0, *offset), out=out)
+        out *= 1 / len(offsets)
+
+    cross = ((-1, 0), (1, 0), (0, -1), (0, 1))
+    diagonal = ((-1, -1), (-1, 1), (1, -1), (1, 1))
+    horizontal = ((0, -1), (0, 1))
+    vertical = ((-1, 0), (1, 0))
+
+    channels = []
+
+    for color in ('R', 'G', 'B'):
+        channel = np.empty((height, width), dtype=dtype)
+
+        for y0 in (0, 1):
+            for x0 in (0, 1):
+                site = bayer_pat[y0 * 2 + x0]
+                out = channel[y0::2, x0::2]
+
+                if site == color:
+                    out[...] = neighbor(y0, x0, 0, 0)
+                elif color == 'G':
+                    average(out, y0, x0, cross)
+                elif site == 'G':
+                    # the horizontal neighbors of a green pixel are either all of this color or none
+                    average(out, y0, x0, horizontal if (y0, 1 - x0) in sites[color] else vertical)
+                else:
+                    average(out, y0, x0, diagonal)
+
+        channels.append(channel)
+
+    return tuple(channels)
+
+def demosaic_superpixel(data: np.ndarray, bayer_pat: str, dtype: type=None):
+    """
+    Collapse every 2x2 Bayer cell into a single RGB pixel, giving half-resolution channels.
+
+    No interpolation is done: red and blue are the cell's red and blue pixels, green is the 
+    average of its two green pixels. A trailing odd row or column is dropped.
+
+    params
+    ------
+    data: np.ndarray
+        2D array of the raw mosaic
+    bayer_pat: str
+        Bayer pattern, one of 'RGGB', 'BGGR', 'GRBG', 'GBRG'
+    dtype: type, optional
+        Floating point type of the channels, default to Precision.working
+
+    return
+    ------
+    tuple(np.ndarray, np.ndarray, np.ndarray)
+        Red, green and blue channels of shape (rows // 2, columns // 2)
+    """
+
+    sites = bayer_sites(bayer_pat)
+    height, width = data.shape
+    dtype = Precision.dtype(dtype)
+    cells = data[:height - height % 2, :width - width % 2]
+
+    (ry, rx), = sites['R']
+    (by, bx), = sites['B']
+    (g1y, g1x), (g2y, g2x) = sites['G']
+
+    red_image = cells[ry::2, rx::2].astype(dtype)
+    blue_image = cells[by::2, bx::2].astype(dtype)
+
+    green_image = cells[g1y::2, g1x::2].astype(dtype)
+    green_image += cells[g2y::2, g2x::2]
+    green_image *= 0.5
+
+    return red_image, green_image, blue_image
+
 def extract_rgb_CV2(float_data, bayer_pat):
     """
     Extracts the red, green, and blue channels from a FITS image based on Bayer pattern using OpenCV.
@@ -210,13 +448,15 @@ def extract_rgb_CV2(float_data, bayer_pat):
     
     # Split the RGB image into individual channels
     red_image, green_image, blue_image = cv2.split(rgb_image)
-    r,g,b = helperfunc.color_equalize_data(red_image,blue_image,green_image)
     
     # Convert channels back to float and scale to match original range
     red_image = red_image.astype(float) / 255 * (max_val - min_val) + min_val
     green_image = green_image.astype(float) / 255 * (max_val - min_val) + min_val
     blue_image = blue_image.astype(float) / 255 * (max_val - min_val) + min_val
 
+    # balance in floating point, the 8-bit channels can't hold the correction
+    red_image, green_image, blue_image = helperfunc.color_equalize_data(red_image, green_image, blue_image)
+
     return red_image, green_image, blue_image, luminance_image
     
 def calculate_luminance(rgb_image):
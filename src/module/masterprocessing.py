@@ -0,0 +1,468 @@
+from astropy.io import fits
+import numpy as np
+import json
+import os
+
+from src.module.darkprocessing import DEFAULT_MEMORY_BUDGET
+from src.util import stats
+from src.util.Fits import *
+
+class MasterBuilder:
+    """
+    Master frame kept up to date incrementally as frames arrive or turn out bad.
+
+    Instead of the frames, the builder keeps per-pixel sufficient statistics on disk: the sum,
+    sum of squares and count of the values added, and a coarse histogram of them. Histogram bins
+    are centered on the first frame added, pixel by pixel, so a few bins of a width set by the
+    temporal noise cover the spread of every pixel (hot pixels included). Adding or removing a
+    frame only touches that frame, the median is read off the histograms, the mean and variance
+    off the sums.
+
+    The statistics are memory-mapped .npy files in the builder directory and are updated in strips
+    of rows, next to a manifest of the frames they hold and the header of the first frame. Before
+    any statistic changes, the frames being added or removed are recorded as pending in the
+    manifest, and every strip is computed in memory and saved to a journal before it is copied into
+    the statistics. A builder interrupted halfway (crash, power loss) finishes the pending update
+    when it is opened again, so no frame is ever counted twice or half.
+    """
+
+    MANIFEST = "manifest.json"
+    HEADER = "header.txt"
+    JOURNAL = "journal.npz"
+
+    def __init__(self, directory: str, bins: int=16, bin_width: float=None, memory_budget: int=DEFAULT_MEMORY_BUDGET):
+        """
+        Open the builder stored in a directory, or prepare a new one.
+
+        params
+        ------
+        directory: str
+            Directory holding the statistics of this master
+        bins: int, optional
+            Number of histogram bins per pixel, two more catch values below and above them.
+            Each bin takes 2 bytes per pixel on disk
+        bin_width: float, optional
+            Width of the histogram bins, estimated from the first frames added when not given
+            (8 standard deviations of the temporal noise spread over the bins)
+        memory_budget: int, optional
+            Approximate amount of memory in bytes a strip of statistics is allowed to take
+        """
+
+        self.directory = directory.replace("\\", "/").rstrip("/")
+        self.memory_budget = memory_budget
+
+        os.makedirs(self.directory, exist_ok=True)
+
+        manifest_path = f"{self.directory}/{self.MANIFEST}"
+        if os.path.isfile(manifest_path):
+            with open(manifest_path) as file:
+                manifest = json.load(file)
+
+            self.shape = tuple(manifest["shape"])
+            self.bins = manifest["bins"]
+            self.bin_width = manifest["bin_width"]
+            self.frames = manifest["frames"]
+            self.pending = manifest.get("pending")
+        else:
+            self.shape = None
+            self.bins = bins
+            self.bin_width = bin_width
+            self.frames = {}
+            self.pending = None
+
+        if self.pending is not None:
+            self.resume()
+
+    def statistic(self, name: str, dtype: type=None, shape: tuple=None):
+        """
+        Memory map of one statistic, created with given dtype and shape if it does not exist yet.
+        """
+
+        path = f"{self.directory}/{name}.npy"
+
+        if dtype is None:
+            return np.lib.format.open_memmap(path, mode="r+")
+        return np.lib.format.open_memmap(path, mode="w+", dtype=dtype, shape=shape)
+
+    def save_manifest(self):
+        """
+        Write the manifest next to the statistics, replacing the old one in one step.
+        """
+
+        manifest_path = f"{self.directory}/{self.MANIFEST}"
+
+        with open(manifest_path + ".tmp", "w") as file:
+            json.dump({"shape": self.shape, "bins": self.bins, "bin_width": self.bin_width, "frames": self.frames, "pending": self.pending}, file)
+        os.replace(manifest_path + ".tmp", manifest_path)
+
+    @staticmethod
+    def frame_key(fits_img: Fits):
+        """
+        Size and modification time identifying the version of a frame file.
+        """
+
+        stat = os.stat(fits_img.path)
+        return [stat.st_size, stat.st_mtime_ns]
+
+    def initialize(self, fits_files: list[Fits]):
+        """
+        Create the statistics files, centering the histograms on the first frame.
+        """
+
+        first = fits_files[0]
+        self.shape = tuple(first.shape())
+        center = np.asarray(first.get_data(), dtype=np.float32)
+
+        if self.bin_width is None:
+            if len(fits_files) < 2:
+                raise ValueError("At least two frames are needed to estimate the histogram bin width, or pass bin_width")
+
+            # temporal noise from the difference of two frames, robust to hot pixels and cosmic rays
+            difference = np.asarray(fits_files[1].get_data(), dtype=np.float32) - center
+            sigma = 1.4826 * stats.mad(difference) / np.sqrt(2)
+            self.bin_width = float(8 * sigma / self.bins) if sigma > 0 else 1.0
+
+        height, width = self.shape
+        self.statistic("center", np.float32, self.shape)[...] = center
+        self.statistic("sum", np.float64, self.shape)
+        self.statistic("sumsq", np.float64, self.shape)
+        self.statistic("count", np.uint16, self.shape)
+        self.statistic("histogram", np.uint16, (height, width, self.bins + 2))
+
+        with open(f"{self.directory}/{self.HEADER}", "w") as file:
+            file.write(first.header.tostring())
+
+    def strip_rows(self):
+        """
+        Number of rows per strip so the statistics and temporaries of a strip fit in the memory budget.
+        """
+
+        # histogram, center, sum, sum of squares and count of the strip, then data, deviation, bin index and bin offset of a frame
+        row_bytes = self.shape[1] * (2 * (self.bins + 2) + 4 + 8 + 8 + 2 + 4 * 8)
+        return max(1, self.memory_budget // row_bytes)
+
+    def apply_journal(self):
+        """
+        Copy the strip saved in the journal into the statistics and record it as done in the
+        manifest, then drop the journal.
+
+        The journal holds the final values of the strip, so copying it again gives the same
+        statistics and an interrupted copy is simply redone. It is only dropped once the manifest
+        records the strip as done, so a crash in between can't get the strip accumulated twice.
+
+        return
+        ------
+        int
+            Row after the last row of the strip, None when there is no journal
+        """
+
+        journal_path = f"{self.directory}/{self.JOURNAL}"
+
+        if not os.path.isfile(journal_path):
+            return None
+
+        with np.load(journal_path) as journal:
+            start, stop = int(journal["start"]), int(journal["stop"])
+
+            for name in ("sum", "sumsq", "count", "histogram"):
+                statistic = self.statistic(name)
+                statistic[start:stop] = journal[name]
+                statistic.flush()
+
+        self.pending["next_row"] = max(self.pending["next_row"], stop)
+        self.save_manifest()
+
+        os.remove(journal_path)
+        return stop
+
+    def accumulate(self, fits_files: list[Fits], sign: int, start_row: int=0):
+        """
+        Add (sign=1) or subtract (sign=-1) frames from every statistic, strip by strip.
+
+        Every strip is computed in memory and journaled before it replaces the one on disk,
+        see apply_journal.
+        """
+
+        center, total, total_sq = self.statistic("center"), self.statistic("sum"), self.statistic("sumsq")
+        count, histogram = self.statistic("count"), self.statistic("histogram")
+
+        height, width = self.shape
+        rows = self.strip_rows()
+
+        # every frame is read once per strip, keep all of them open for the whole update
+        with Fits.pool.working_set(len(fits_files)):
+            for start in range(start_row, height, rows):
+                stop = min(start + rows, height)
+                strip_center = center[start:stop]
+                strip_total = np.array(total[start:stop])
+                strip_total_sq = np.array(total_sq[start:stop])
+                strip_count = np.array(count[start:stop])
+                strip_histogram = np.array(histogram[start:stop])
+                flat_histogram = strip_histogram.reshape(-1)
+                # offset of the first bin of every pixel in the flattened strip histogram
+                offsets = np.arange(0, flat_histogram.size, self.bins + 2).reshape(stop - start, width)
+
+                for fits_img in fits_files:
+                    data = np.asarray(fits_img.get_rows(start, stop), dtype=np.float64)
+
+                    strip_total += sign * data
+                    strip_count += np.uint16(1) if sign > 0 else np.uint16(0xFFFF)
+
+                    # squares of the deviations from the center rather than of the values, so the
+                    # variance does not get lost in cancellation between two large sums
+                    deviation = data - strip_center
+                    strip_total_sq += sign * deviation * deviation
+
+                    # bin 0 and bins + 1 collect everything below and above the histogram range
+                    index = np.floor(deviation / self.bin_width + self.bins / 2) + 1
+                    np.clip(index, 0, self.bins + 1, out=index)
+
+                    # every pixel hits exactly one bin, so plain fancy indexing does not lose updates
+                    flat_histogram[offsets + index.astype(np.intp)] += np.uint16(1) if sign > 0 else np.uint16(0xFFFF)
+
+                journal_path = f"{self.directory}/{self.JOURNAL}"
+                with open(journal_path + ".tmp", "wb") as file:
+                    np.savez(file, start=start, stop=stop, sum=strip_total, sumsq=strip_total_sq, count=strip_count, histogram=strip_histogram)
+                os.replace(journal_path + ".tmp", journal_path)
+
+                self.apply_journal()
+
+    def update(self, fits_files: list[Fits], sign: int):
+        """
+        Add (sign=1) or remove (sign=-1) frames, recording them as pending until every strip is done.
+        """
+
+        self.pending = {"sign": sign, "frames": {fits_img.path: MasterBuilder.frame_key(fits_img) for fits_img in fits_files}, "next_row": 0}
+        self.save_manifest()
+
+        self.accumulate(fits_files, sign)
+        self.finish()
+
+    def finish(self):
+        """
+        Move the pending frames into (or out of) the frames held, once every strip holds them.
+        """
+
+        for path, key in self.pending["frames"].items():
+            if self.pending["sign"] > 0:
+                self.frames[path] = key
+            else:
+                del self.frames[path]
+
+        self.pending = None
+        self.save_manifest()
+
+    def resume(self):
+        """
+        Finish an update that was interrupted, from the first strip that was not saved.
+
+        The pending frames are read again, so they must be unchanged since the update started.
+        """
+
+        self.apply_journal()
+        start_row = self.pending["next_row"]
+
+        fits_files = [Fits(path, lazy=True) for path in self.pending["frames"]]
+        for fits_img in fits_files:
+            if MasterBuilder.frame_key(fits_img) != self.pending["frames"][fits_img.path]:
+                raise ValueError(f"{fits_img.path} changed during an interrupted update of {self.directory}, rebuild the master instead")
+
+        print(f"Resuming the interrupted update of {self.directory} from row {start_row}")
+
+        self.accumulate(fits_files, self.pending["sign"], start_row)
+        self.finish()
+
+    def add(self, fits_files: list[Fits]):
+        """
+        Add frames to the master, frames it already holds are skipped.
+
+        params
+        ------
+        fits_files: list[Fits]
+            Frames to be added, preferably lazy ones so they are read strip by strip
+
+        return
+        ------
+        int
+            Number of frames added
+        """
+
+        new = [fits_img for fits_img in fits_files if fits_img.path not in self.frames]
+
+        if not new:
+            return 0
+
+        if self.shape is None:
+            self.initialize(new)
+
+        for fits_img in new:
+            if tuple(fits_img.shape()) != self.shape:
+                raise ValueError(f"Shape of {fits_img.path} does not match the master ({self.shape})")
+
+        if len(self.frames) + len(new) > 0xFFFF:
+            raise ValueError("A master can hold at most 65535 frames")
+
+        self.update(new, 1)
+
+        print(f"Added {len(new)} frames to {self.directory}, now holding {len(self.frames)}")
+        return len(new)
+
+    def remove(self, fits_files: list[Fits]):
+        """
+        Remove frames from the master, frames it does not hold are skipped.
+
+        The frames have to be unchanged since they were added, their values are what gets subtracted.
+
+        params
+        ------
+        fits_files: list[Fits]
+            Frames to be removed
+
+        return
+        ------
+        int
+            Number of frames removed
+        """
+
+        old = [fits_img for fits_img in fits_files if fits_img.path in self.frames]
+
+        for fits_img in old:
+            if MasterBuilder.frame_key(fits_img) != self.frames[fits_img.path]:
+                raise ValueError(f"{fits_img.path} changed since it was added, rebuild the master instead")
+
+        if not old:
+            return 0
+
+        self.update(old, -1)
+
+        print(f"Removed {len(old)} frames from {self.directory}, now holding {len(self.frames)}")
+        return len(old)
+
+    def sync(self, fits_files: list[Fits]):
+        """
+        Make the master hold exactly the given frames, adding new ones and removing the rest.
+
+        Frames that are gone from disk can't be subtracted anymore and raise FileNotFoundError.
+
+        params
+        ------
+        fits_files: list[Fits]
+            Frames the master should be built from
+        """
+
+        paths = {fits_img.path for fits_img in fits_files}
+        stale = [Fits(path, lazy=True) for path in self.frames if path not in paths]
+
+        self.remove(stale)
+        self.add(fits_files)
+
+    def mean(self):
+        """
+        Mean of the frames held.
+
+        Nothing is rejected, unlike darkprocessing.mean_stack_fits which sigma clips every pixel,
+        so outliers (cosmic rays, satellite trails) pull this mean and it does not match the batch
+        mean master. Use median() where outliers matter.
+        """
+
+        count = self.statistic("count")
+        return np.divide(self.statistic("sum"), count, out=np.zeros(self.shape), where=count > 0)
+
+    def variance(self):
+        """
+        Unbiased variance of the frames held, 0 for pixels held by fewer than two frames.
+
+        Like mean(), nothing is rejected.
+        """
+
+        center, total, total_sq, count = self.statistic("center"), self.statistic("sum"), self.statistic("sumsq"), self.statistic("count")
+
+        height, width = self.shape
+        rows = self.strip_rows()
+        variance = np.zeros(self.shape)
+
+        for start in range(0, height, rows):
+            stop = min(start + rows, height)
+            strip_count = count[start:stop].astype(np.float64)
+
+            # squared deviations from the mean, from those from the center
+            deviation = total[start:stop] - strip_count * center[start:stop]
+            squares = total_sq[start:stop] - np.divide(deviation * deviation, strip_count, out=np.zeros(deviation.shape), where=strip_count > 0)
+
+            np.divide(np.maximum(squares, 0), strip_count - 1, out=variance[start:stop], where=strip_count > 1)
+
+        return variance
+
+    def std(self):
+        """
+        Standard deviation of the frames held, see variance.
+        """
+
+        return np.sqrt(self.variance())
+
+    def median(self):
+        """
+        Median of the frames held, interpolated within the histogram bin it falls in.
+
+        Pixels whose median lies outside the histogram range (e.g. the first frame had a cosmic ray
+        there) fall back to the mean.
+        """
+
+        center, total, count, histogram = self.statistic("center"), self.statistic("sum"), self.statistic("count"), self.statistic("histogram")
+
+        height, width = self.shape
+        rows = self.strip_rows()
+        median = np.zeros(self.shape)
+
+        for start in range(0, height, rows):
+            stop = min(start + rows, height)
+            strip_count = count[start:stop].astype(np.float64)
+            cumulative = np.cumsum(histogram[start:stop], axis=-1, dtype=np.int64)
+
+            half = strip_count / 2
+            index = np.argmax(cumulative >= half[..., np.newaxis], axis=-1)
+
+            below = np.take_along_axis(cumulative, np.maximum(index - 1, 0)[..., np.newaxis], axis=-1)[..., 0]
+            below[index == 0] = 0
+            inside = np.take_along_axis(cumulative, index[..., np.newaxis], axis=-1)[..., 0] - below
+
+            fraction = np.divide(half - below, inside, out=np.full(half.shape, 0.5), where=inside > 0)
+            strip_median = center[start:stop] + (index - 1 - self.bins / 2 + fraction) * self.bin_width
+
+            outside = (index == 0) | (index == self.bins + 1)
+            strip_mean = np.divide(total[start:stop], strip_count, out=np.zeros(half.shape), where=strip_count > 0)
+            median[start:stop] = np.where(outside | (strip_count == 0), strip_mean, strip_median)
+
+        return median
+
+    def create_master(self, output_file: str, stack: str="median"):
+        """
+        Create the master frame in memory, like Fits.filecreate it is written with diskwrite.
+
+        params
+        ------
+        output_file: str
+            Path to where the output is going to be written
+        stack: str, optional
+            "median" or "mean"
+
+        return
+        ------
+        Fits
+            Newly created Fits object with the master data
+        """
+
+        if not self.frames:
+            raise ValueError(f"No frames in {self.directory}")
+
+        if stack == "median":
+            data = self.median()
+        elif stack == "mean":
+            data = self.mean()
+        else:
+            raise ValueError(f"Invalid stacking method: {stack}")
+
+        with open(f"{self.directory}/{self.HEADER}") as file:
+            header = fits.Header.fromstring(file.read())
+
+        return Fits.filecreate(output_file, data, header)
@@ -0,0 +1,285 @@
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+from src.module import flatprocessing
+from src.util import helperfunc, outputimg
+from src.util.Fits import *
+
+# color balance statistics are estimated from about this many pixels of each channel
+BALANCE_SAMPLE_SIZE = 1_000_000
+
+def calibrate_frame(sci_img: Fits, dark_cal: tuple[Fits, ...], flat_cal: tuple[Fits, ...], directory: str=Constant.SCIENCE_PATH, superpixel: bool=False, raw: bool=False, balance: bool=False):
+    """
+    Apply dark and flat correction to a science frame and split it into its color channels.
+
+    By default the frame is split first and each channel is corrected with the matching channel 
+    of the masters. In raw mode the correction is done once on the Bayer mosaic with raw masters, 
+    and only the calibrated mosaic gets split into channels. Either way dark subtraction and flat 
+    division run as one fused in-place pass (flatprocessing.calibrate_fits).
+
+    params
+    ------
+    sci_img: Fits
+        Fits object of the raw science frame, left unmodified
+    dark_cal: tuple(Fits, ...)
+        Red, green and blue channels of the master dark, or the raw master dark alone in raw mode
+    flat_cal: tuple(Fits, ...)
+        Reciprocals (flatprocessing.reciprocal_flat) of the red, green and blue channels of the 
+        dark-subtracted, normalized master flat, or of that flat as a raw mosaic alone in raw mode
+    directory: str, optional
+        Directory path as string for the channel Fits objects
+    superpixel: bool, optional
+        Extract half-resolution superpixel channels, the master channels must be extracted the same way
+    raw: bool, optional
+        Calibrate the mosaic before splitting it into channels
+    balance: bool, optional
+        Color balance the calibrated channels (helperfunc.color_equalize_data)
+
+    return
+    ------
+    tuple(Fits, Fits, Fits, str)
+        The calibrated red, green and blue channels, and the file name of the science frame
+    """
+
+    fp = sci_img.path
+    fn = fp[fp.rfind("/") + 1: len(fp) - 5] # get filename
+
+    if raw:
+        # work on an in-memory Fits object, so the science frame itself can still be released
+        mosaic = Fits.filecreate(fp, sci_img.get_data(), sci_img.header)
+        flatprocessing.calibrate_fits(mosaic, dark_cal[0], flat_cal[0])
+
+        sci_rgb = helperfunc.extract_rgb_from_fits(mosaic, directory, superpixel) + (fn,)
+    else:
+        sci_rgb = helperfunc.extract_rgb_from_fits(sci_img, directory, superpixel) + (fn,) # tuple is now (r, g, b, fn)
+
+        # channels are freshly extracted float arrays, calibrate them in place
+        for j in range(0, 3):
+            flatprocessing.calibrate_fits(sci_rgb[j], dark_cal[j], flat_cal[j], out=sci_rgb[j].get_data())
+
+    if balance:
+        # in place as well, the channels already hold their arrays
+        datas = [sci_rgb[j].get_data() for j in range(0, 3)]
+        step = max(1, int(np.sqrt(datas[0].size / BALANCE_SAMPLE_SIZE)))
+        helperfunc.color_equalize_data(*datas, step=step)
+
+    return sci_rgb
+
+def calibrate_stream(sci_imgs: list[Fits], dark_cal: tuple[Fits, ...], flat_cal: tuple[Fits, ...], directory: str=Constant.SCIENCE_PATH, superpixel: bool=False, raw: bool=False, balance: bool=False):
+    """
+    Generator calibrating science frames one at a time.
+
+    Each frame is only read when the previous one has been handed out, and its file handle 
+    and raw data are released right after, so memory stays at one frame no matter how many 
+    frames there are, as long as the caller drops each result before asking for the next.
+
+    params
+    ------
+    sci_imgs: list[Fits]
+        Fits objects of the raw science frames, preferably lazy ones
+    dark_cal: tuple(Fits, ...)
+        Master dark channels, or the raw master dark in raw mode, see calibrate_frame
+    flat_cal: tuple(Fits, ...)
+        Reciprocal master flat channels, or the reciprocal raw master flat in raw mode, see calibrate_frame
+    directory: str, optional
+        Directory path as string for the channel Fits objects
+    superpixel: bool, optional
+        Extract half-resolution superpixel channels, the master channels must be extracted the same way
+    raw: bool, optional
+        Calibrate the mosaic before splitting it into channels
+    balance: bool, optional
+        Color balance the calibrated channels
+
+    return
+    ------
+    Generator[tuple(Fits, Fits, Fits, str)]
+        The calibrated red, green and blue channels and the file name, frame by frame
+    """
+
+    for sci_img in sci_imgs:
+        sci_rgb = calibrate_frame(sci_img, dark_cal, flat_cal, directory, superpixel, raw, balance)
+
+        # the channels are new Fits objects, the raw frame is not needed anymore
+        sci_img.close()
+
+        yield sci_rgb
+
+def frame_outputs(sci_rgb: tuple, directory: str=Constant.SCIENCE_PATH, layout: str="channels", compression: str=None):
+    """
+    Fits objects a calibrated frame is written as.
+
+    params
+    ------
+    sci_rgb: tuple(Fits, Fits, Fits, str)
+        Calibrated channels and file name, from calibrate_frame
+    directory: str, optional
+        Directory path as string for multi-channel files
+    layout: str, optional
+        "channels" for one file per channel, "mef" or "cube" for a single file per frame (see Fits.channelcreate)
+    compression: str, optional
+        Tile compression of multi-channel files, e.g. "RICE_1"
+
+    return
+    ------
+    list[Fits]
+        The three channels, or one Fits object holding all of them named with "_rgb" at the end
+    """
+
+    if layout == "channels":
+        return list(sci_rgb[:3])
+
+    return [Fits.channelcreate(directory + sci_rgb[3] + "_rgb.fits", sci_rgb[:3], layout=layout, compression=compression)]
+
+class SharedChannels:
+    """
+    Copy of a set of Fits channels placed in shared memory, so worker processes can read the
+    master frames without having them pickled for every task.
+
+    Created by the parent process, which owns the memory and releases it with close().
+    Worker processes rebuild the channels from the picklable `specs` with attach().
+    """
+
+    def __init__(self, channels: list[Fits]):
+        self.blocks = []
+        self.specs = []
+
+        for channel in channels:
+            data = np.asarray(channel.get_data())
+            block = shared_memory.SharedMemory(create=True, size=max(data.nbytes, 1))
+            np.ndarray(data.shape, dtype=data.dtype, buffer=block.buf)[...] = data
+
+            self.blocks.append(block)
+            self.specs.append((block.name, data.shape, data.dtype.str, channel.path))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        """
+        Release the shared memory, only call once every worker is done with it.
+        """
+
+        for block in self.blocks:
+            block.close()
+            block.unlink()
+        self.blocks = []
+
+    @staticmethod
+    def attach(specs: list[tuple]):
+        """
+        Static method to rebuild the channels inside a worker process.
+
+        params
+        ------
+        specs: list[tuple]
+            The specs attribute of the SharedChannels created by the parent process
+
+        return
+        ------
+        tuple(list[SharedMemory], list[Fits])
+            The attached memory blocks, which must be kept alive while the channels are used,
+            and Fits objects whose data lives in them
+        """
+
+        blocks = []
+        channels = []
+
+        for name, shape, dtype, path in specs:
+            # pool workers share the resource tracker of the parent, which unlinks the block in close()
+            block = shared_memory.SharedMemory(name=name)
+            data = np.ndarray(shape, dtype=np.dtype(dtype), buffer=block.buf)
+            data.flags.writeable = False
+
+            blocks.append(block)
+            channels.append(Fits.filecreate(path, data))
+
+        return blocks, channels
+
+# per-process state of calibration workers, set up once by init_worker
+_worker = {}
+
+def init_worker(dark_specs: list[tuple], flat_specs: list[tuple], precision: tuple):
+    """
+    Process pool initializer attaching the master channels shared by the parent process
+    and taking over its precision policy.
+    """
+
+    Precision.working, Precision.storage = precision
+
+    dark_blocks, dark_cal = SharedChannels.attach(dark_specs)
+    flat_blocks, flat_cal = SharedChannels.attach(flat_specs)
+
+    _worker["blocks"] = dark_blocks + flat_blocks
+    _worker["dark_cal"] = tuple(dark_cal)
+    _worker["flat_cal"] = tuple(flat_cal)
+
+def calibrate_path(path: str, directory: str, superpixel: bool, raw: bool, write: bool, layout: str="channels", compression: str=None, preview: dict=None, balance: bool=False):
+    """
+    Task run in a worker process: load, calibrate and optionally write one science frame and its preview.
+
+    Only the file name travels back to the parent process, the frame is written by the worker.
+    """
+
+    sci_rgb = calibrate_frame(Fits(path, lazy=True), _worker["dark_cal"], _worker["flat_cal"], directory, superpixel, raw, balance)
+
+    if write:
+        for output in frame_outputs(sci_rgb, directory, layout, compression):
+            output.diskwrite()
+
+    if preview is not None:
+        outputimg.generate_preview(sci_rgb[3] + "_pre_align", sci_rgb[:3], **preview)
+
+    return sci_rgb[3]
+
+def calibrate_parallel(sci_paths: list[str], dark_cal: tuple[Fits, ...], flat_cal: tuple[Fits, ...], jobs: int, write: bool=False, directory: str=Constant.SCIENCE_PATH, superpixel: bool=False, raw: bool=False, layout: str="channels", compression: str=None, preview: dict=None, balance: bool=False):
+    """
+    Calibrate science frames on a pool of worker processes.
+
+    The master dark and flat (channels) are copied once into shared memory that every worker maps,
+    each task then only carries the path of its science frame.
+
+    params
+    ------
+    sci_paths: list[str]
+        Paths to the raw science frames
+    dark_cal: tuple(Fits, ...)
+        Master dark channels, or the raw master dark in raw mode, see calibrate_frame
+    flat_cal: tuple(Fits, ...)
+        Reciprocal master flat channels, or the reciprocal raw master flat in raw mode, see calibrate_frame
+    jobs: int
+        Number of worker processes
+    write: bool, optional
+        Have the workers write the calibrated channels to disk
+    directory: str, optional
+        Directory path as string for the channel Fits objects
+    superpixel: bool, optional
+        Extract half-resolution superpixel channels, the master channels must be extracted the same way
+    raw: bool, optional
+        Calibrate the mosaic before splitting it into channels
+    layout: str, optional
+        How written frames are laid out, see frame_outputs
+    compression: str, optional
+        Tile compression of multi-channel files, see frame_outputs
+    preview: dict, optional
+        Have the workers render a preview of every frame, with these options of outputimg.generate_preview
+        (extension, level, boost_factor, ...)
+    balance: bool, optional
+        Color balance the calibrated channels
+
+    return
+    ------
+    list
+        File names of the calibrated science frames, in the order of sci_paths
+    """
+
+    # workers are not forked, a fork while other threads (e.g. a FitsWriter) hold a lock leaves the worker waiting on it forever
+    context = helperfunc.process_context()
+
+    with SharedChannels(dark_cal) as shared_dark, SharedChannels(flat_cal) as shared_flat:
+        with ProcessPoolExecutor(max_workers=jobs, mp_context=context, initializer=init_worker, initargs=(shared_dark.specs, shared_flat.specs, (Precision.working, Precision.storage))) as executor:
+            count = len(sci_paths)
+            return list(executor.map(calibrate_path, sci_paths, [directory] * count, [superpixel] * count, [raw] * count, [write] * count, [layout] * count, [compression] * count, [preview] * count, [balance] * count))
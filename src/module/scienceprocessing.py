@@ -1,7 +1,16 @@
 import astroalign
 import numpy as np
+import hashlib
+import json
+import os
+import cv2
+import sep
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from scipy.special import ndtr, stdtrit
+from skimage.transform import SimilarityTransform, warp
 
 from src.util.Fits import *
+from src.util import helperfunc
 
 def find_matrix_t(target_fits: Fits, reference_fits: Fits):
     """
@@ -12,23 +21,408 @@ def find_matrix_t(target_fits: Fits, reference_fits: Fits):
     reference_data = np.array(reference_fits.get_data())
 
     # use 4 stddevs to consider star pixels
-    t_matrix = astroalign.find_transform(target_data, reference_data, detection_sigma=4) 
+    t_matrix = astroalign.find_transform(target_data, reference_data, detection_sigma=4)
     return t_matrix
 
+def find_stars(data: np.ndarray, detection_sigma: float=4, max_control_points: int=50, min_area: int=5):
+    """
+    Detect stars in an image with sep, the way astroalign does before matching.
+
+    params
+    ------
+    data: np.ndarray
+        2D image data
+    detection_sigma: float, optional
+        Background standard deviations above which pixels are considered star pixels
+    max_control_points: int, optional
+        Number of brightest stars to keep
+    min_area: int, optional
+        Minimum number of connected pixels of a star
+
+    return
+    ------
+    np.ndarray
+        (x, y) positions of the stars, brightest first
+    """
+
+    # sep needs a contiguous native-endian array, FITS data is big-endian
+    image = np.ascontiguousarray(data, dtype=np.float32)
+
+    background = sep.Background(image)
+    sources = sep.extract(image - background.back(), detection_sigma * background.globalrms, minarea=min_area)
+
+    brightest = np.argsort(sources["flux"])[::-1][:max_control_points]
+    return np.column_stack((sources["x"][brightest], sources["y"][brightest]))
+
+def detect_and_match(frame, reference_points: np.ndarray, detection_sigma: float, max_control_points: int):
+    """
+    Detect the stars of a target image and match them against already detected reference stars.
+
+    Module-level so it can run in worker processes.
+
+    params
+    ------
+    frame: str | np.ndarray
+        Path to a FITS file, read here, or image data of a frame that only lives in memory
+    reference_points, detection_sigma, max_control_points
+        See BatchAligner
+
+    return
+    ------
+    np.ndarray
+        3x3 matrix of the similarity transform mapping target pixels onto the reference
+    """
+
+    if isinstance(frame, str):
+        with Fits(frame, lazy=True) as fits_img:
+            data = np.asarray(fits_img.get_data(), dtype=np.float32)
+    else:
+        data = frame
+
+    target_points = find_stars(data, detection_sigma, max_control_points)
+    transform = astroalign.find_transform(target_points, reference_points, max_control_points=max_control_points)[0]
+    return transform.params
+
+class BatchAligner:
+    """
+    Star aligner for many frames against one reference frame.
+
+    Stars of the reference are detected once on creation, every target then only needs its own
+    detection before its asterisms are matched against the reference stars. Transforms can be
+    computed on a process pool and are cached on disk, keyed by a fingerprint of the target and
+    of the reference, so re-aligning the same sequence costs nothing.
+    """
+
+    def __init__(self, reference_fits: Fits, detection_sigma: float=4, max_control_points: int=50, cache_dir: str=Constant.TRANSFORM_CACHE_PATH):
+        """
+        params
+        ------
+        reference_fits: Fits
+            Fits object every target gets aligned to
+        detection_sigma: float, optional
+            Background standard deviations above which pixels are considered star pixels, default to 4
+        max_control_points: int, optional
+            Number of brightest stars used for matching
+        cache_dir: str | None, optional
+            Directory of the transform cache, None disables caching
+        """
+
+        self.detection_sigma = detection_sigma
+        self.max_control_points = max_control_points
+        self.cache_dir = cache_dir.replace("\\", "/").rstrip("/") if cache_dir else None
+
+        self.reference_points = find_stars(reference_fits.get_data(), detection_sigma, max_control_points)
+        self.reference_key = BatchAligner.fingerprint(reference_fits)
+
+        if len(self.reference_points) < 3:
+            raise ValueError(f"Reference stars in {reference_fits.path} are less than the minimum value (3).")
+
+        if self.cache_dir:
+            os.makedirs(self.cache_dir, exist_ok=True)
+
+    @staticmethod
+    def fingerprint(fits_img: Fits):
+        """
+        Static method identifying the contents of a Fits object, see Fits.fingerprint.
+        """
+
+        return fits_img.fingerprint()
+
+    def cache_path(self, target_key: str):
+        """
+        Path of the cached transform of a target, which also depends on the reference and detection settings.
+        """
+
+        key = hashlib.sha256(f"{target_key}\0{self.reference_key}\0{self.detection_sigma}\0{self.max_control_points}".encode()).hexdigest()
+        return f"{self.cache_dir}/{key}.json"
+
+    def find_transforms(self, targets: list[Fits], workers: int=1):
+        """
+        Find the transforms aligning each target to the reference.
+
+        params
+        ------
+        targets: list[Fits]
+            Fits objects to be aligned
+        workers: int, optional
+            Number of worker processes detecting and matching uncached targets, default to 1 (no pool)
+
+        return
+        ------
+        list[SimilarityTransform]
+            Transforms mapping each target onto the reference, in the order of targets.
+            Pass them to align_fits
+        """
+
+        matrices = [None] * len(targets)
+        paths = [None] * len(targets)
+
+        for i, target in enumerate(targets):
+            if self.cache_dir:
+                paths[i] = self.cache_path(BatchAligner.fingerprint(target))
+
+                if os.path.isfile(paths[i]):
+                    with open(paths[i]) as file:
+                        matrices[i] = np.array(json.load(file)["params"])
+
+        missing = [i for i in range(len(targets)) if matrices[i] is None]
+        count = len(missing)
+
+        def frame(i):
+            # workers read frames that match their file themselves, only in-memory data is sent
+            target = targets[i]
+            return target.path if target.matches_file else np.asarray(target.get_data(), dtype=np.float32)
+
+        def found(i, params):
+            matrices[i] = params
+
+            if self.cache_dir:
+                with open(paths[i] + ".tmp", "w") as file:
+                    json.dump({"params": params.tolist()}, file)
+                os.replace(paths[i] + ".tmp", paths[i])
+
+        if workers > 1 and count > 1:
+            # at most two frames per worker are in flight, so a large batch is never held in memory at once
+            with ProcessPoolExecutor(max_workers=workers, mp_context=helperfunc.process_context()) as executor:
+                pending = {}
+                for i in missing:
+                    if len(pending) >= 2 * workers:
+                        done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                        for future in done:
+                            found(pending.pop(future), future.result())
+
+                    pending[executor.submit(detect_and_match, frame(i), self.reference_points, self.detection_sigma, self.max_control_points)] = i
+
+                for future in wait(pending).done:
+                    found(pending[future], future.result())
+        else:
+            for i in missing:
+                found(i, detect_and_match(frame(i), self.reference_points, self.detection_sigma, self.max_control_points))
+
+        if count:
+            print(f"Found {count} transforms, {len(targets) - count} loaded from cache")
+
+        return [SimilarityTransform(matrix=matrix) for matrix in matrices]
+
+    def find_transform(self, target: Fits):
+        """
+        Find the transform aligning a single target to the reference, see find_transforms.
+        """
+
+        return self.find_transforms([target])[0]
+
+def downsample_luminance(data: np.ndarray, factor: int=2):
+    """
+    Downsample an image by averaging factor x factor blocks.
+
+    With an even factor every block of a raw Bayer mosaic holds whole 2x2 cells, so the result
+    is a luminance image whatever the Bayer pattern.
+
+    params
+    ------
+    data: np.ndarray
+        2D image data, raw mosaic or single channel
+    factor: int, optional
+        Block size, default to 2
+
+    return
+    ------
+    np.ndarray
+        float32 image of size (height // factor, width // factor), trailing rows and columns are dropped
+    """
+
+    height = data.shape[0] // factor * factor
+    width = data.shape[1] // factor * factor
+
+    return data[:height, :width].reshape(height // factor, factor, width // factor, factor).mean(axis=(1, 3), dtype=np.float32)
+
+class TranslationAligner:
+    """
+    Aligner for sequences that only drift by a translation.
+
+    Shifts are estimated by FFT phase correlation of downsampled luminance images against the
+    reference, whose spectrum is computed once, and refined to sub-pixel precision around the
+    correlation peak. Frames whose peak is too weak (rotation, clouds, too few stars) fall back
+    to star matching with a BatchAligner.
+    """
+
+    def __init__(self, reference_fits: Fits, downsample: int=2, min_quality: float=0.2, fallback: BatchAligner=None):
+        """
+        params
+        ------
+        reference_fits: Fits
+            Fits object every target gets aligned to
+        downsample: int, optional
+            Block size the images are averaged over before correlating, default to 2
+        min_quality: float, optional
+            Minimum height of the phase correlation peak (1 for identical images) for a shift to be
+            trusted, frames below it are handed to the fallback
+        fallback: BatchAligner, optional
+            Star aligner for frames with low peak quality, created from reference_fits when first needed
+        """
+
+        self.reference_fits = reference_fits
+        self.downsample = downsample
+        self.min_quality = min_quality
+        self.fallback = fallback
+
+        thumbnail = downsample_luminance(np.asarray(reference_fits.get_data()), downsample)
+
+        # taper the edges, so image borders don't correlate with each other
+        self.window = np.outer(np.hanning(thumbnail.shape[0]), np.hanning(thumbnail.shape[1])).astype(np.float32)
+        self.reference_fft = np.conj(np.fft.rfft2((thumbnail - thumbnail.mean()) * self.window))
+
+        # Gaussian low-pass turning the correlation peak from a sinc into a Gaussian of 1 px sigma,
+        # whose position the log-parabola fit in find_shift recovers without bias
+        fy = np.fft.fftfreq(thumbnail.shape[0])[:, np.newaxis]
+        fx = np.fft.rfftfreq(thumbnail.shape[1])[np.newaxis, :]
+        self.lowpass = np.exp(-2 * np.pi ** 2 * (fx ** 2 + fy ** 2)).astype(np.float32)
+        # height of the peak of identical images, quality is measured relative to it
+        self.peak_scale = np.fft.irfft2(self.lowpass, s=thumbnail.shape)[0, 0]
+
+    def find_shift(self, target: Fits):
+        """
+        Estimate the translation of a target relative to the reference.
+
+        params
+        ------
+        target: Fits
+            Fits object to be aligned, same shape as the reference
+
+        return
+        ------
+        tuple(float, float, float)
+            x and y shift of the target in full-resolution pixels, and the correlation peak quality
+        """
+
+        thumbnail = downsample_luminance(np.asarray(target.get_data()), self.downsample)
+
+        if thumbnail.shape != self.window.shape:
+            raise ValueError(f"Shape of {target.path} does not match the reference")
+
+        cross_power = np.fft.rfft2((thumbnail - thumbnail.mean()) * self.window) * self.reference_fft
+        cross_power /= np.maximum(np.abs(cross_power), 1e-12)
+        cross_power *= self.lowpass
+        correlation = np.fft.irfft2(cross_power, s=thumbnail.shape)
+
+        height, width = correlation.shape
+        y, x = np.unravel_index(np.argmax(correlation), correlation.shape)
+        peak = correlation[y, x]
+
+        # fit a parabola through the logarithm of the peak and its (wrapped) neighbours along each axis,
+        # exact for a Gaussian peak
+        def refine(left, right):
+            if left <= 0 or right <= 0:
+                return 0.0
+            left, center, right = np.log(left), np.log(peak), np.log(right)
+            curvature = left - 2 * center + right
+            return 0.5 * (left - right) / curvature if curvature < 0 else 0.0
+
+        dy = y + refine(correlation[y - 1, x], correlation[(y + 1) % height, x])
+        dx = x + refine(correlation[y, x - 1], correlation[y, (x + 1) % width])
+
+        # peaks past the middle are negative shifts
+        dy = dy - height if dy > height / 2 else dy
+        dx = dx - width if dx > width / 2 else dx
+
+        return dx * self.downsample, dy * self.downsample, float(peak / self.peak_scale)
+
+    def find_transforms(self, targets: list[Fits], workers: int=1):
+        """
+        Find the translations aligning each target to the reference.
+
+        params
+        ------
+        targets: list[Fits]
+            Fits objects to be aligned
+        workers: int, optional
+            Number of threads reading and correlating targets, also passed to the fallback, default to 1
+
+        return
+        ------
+        list[SimilarityTransform]
+            Transforms mapping each target onto the reference, in the order of targets.
+            Pass them to align_fits
+        """
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            shifts = list(executor.map(self.find_shift, targets))
+
+        transforms = [SimilarityTransform(translation=(-dx, -dy)) for dx, dy, _ in shifts]
+        weak = [i for i, (_, _, quality) in enumerate(shifts) if quality < self.min_quality]
+
+        if weak:
+            print(f"Phase correlation too weak for {len(weak)} of {len(targets)} frames, matching stars instead")
+
+            if self.fallback is None:
+                self.fallback = BatchAligner(self.reference_fits)
+
+            for i, transform in zip(weak, self.fallback.find_transforms([targets[i] for i in weak], workers)):
+                transforms[i] = transform
+
+        return transforms
+
+def warp_data(data: np.ndarray, matrix_t, cval: float):
+    """
+    Warp image data onto the reference with bicubic interpolation.
+
+    params
+    ------
+    data: np.ndarray
+        2D image data of the target
+    matrix_t: SimilarityTransform
+        Transform mapping target pixels onto the reference
+    cval: float
+        Value of pixels not covered by the target, np.nan marks them for stacking
+
+    return
+    ------
+    np.ndarray
+        Warped data of the same shape, clipped to the range of the input
+    """
+
+    height, width = data.shape
+
+    if np.allclose(matrix_t.params[:2, :2], np.eye(2)):
+        # pure translation, shift with OpenCV, which needs native byte order
+        data = data.astype(np.float32 if data.dtype.kind == "f" and data.itemsize == 4 else np.float64, copy=False)
+
+        # the border is replicated rather than set to cval, OpenCV weighs it in whole blocks of
+        # pixels, so a NaN border would spread far into the image
+        transform = cv2.warpAffine(data, matrix_t.params[:2], (width, height), flags=cv2.INTER_CUBIC,
+                                   borderMode=cv2.BORDER_REPLICATE)
+        # keep the input range like warp(clip=True) does, cubic interpolation overshoots around stars
+        np.clip(transform, data.min(), data.max(), out=transform)
+
+        # set every pixel mapped from outside the target to cval
+        tx, ty = matrix_t.params[:2, 2]
+        left, right = max(0, int(np.ceil(tx))), min(width, int(np.floor(width - 1 + tx)) + 1)
+        top, bottom = max(0, int(np.ceil(ty))), min(height, int(np.floor(height - 1 + ty)) + 1)
+
+        transform[:top] = cval
+        transform[bottom:] = cval
+        transform[:, :left] = cval
+        transform[:, right:] = cval
+
+        return transform
+
+    # same warp as astroalign.apply_transform, without the footprint mask it computes alongside
+    return warp(data, inverse_map=matrix_t.inverse, output_shape=data.shape, order=3, mode="constant",
+                cval=cval, clip=True, preserve_range=True)
+
 def align_fits(target_fits:Fits, matrix_t, overwrite: bool=True, output_path: str=None):
     """
     apply transformation matrix to FITS
     """
 
     target_data = np.array(target_fits.get_data())
-    shape = np.zeros(target_data.shape)
-    transform = astroalign.apply_transform(matrix_t, target_data, shape, np.median(target_data))[0] # index 0 is the actual matrix, no idea what the other one (mask layer or whatever) is for
+    transform = warp_data(target_data, matrix_t, np.median(target_data))
 
     if overwrite:
         target_fits.set_data(transform)
     else:
         # Get a copy of header to retain information from original FITS
-        header_copy = target_fits.hdul[0].header
+        header_copy = target_fits.header
 
         # if output path is specified, do as so
         if (output_path):
@@ -38,4 +432,226 @@ def align_fits(target_fits:Fits, matrix_t, overwrite: bool=True, output_path: st
         else:
             new_path = target_fits.path[:len(target_fits.path) - 5] + "_align.fits"
 
-        return Fits.filecreate(new_path, target_data, header_copy)
\ No newline at end of file
+        return Fits.filecreate(new_path, transform, header_copy)
+
+class StackAccumulator:
+    """
+    Running sums of aligned frames, so a sequence is co-added one frame at a time without
+    holding the aligned cube.
+
+    Every pixel keeps the sum, sum of squares and number of values added to it. Once a pixel has
+    min_count values, a new value too far from its running mean is rejected (online sigma
+    clipping). The mean and (unbiased) standard deviation of n values are only estimates, a
+    plain kappa sigma test against them rejects far more than the nominal share of Gaussian noise
+    while n is small, and keeps rejecting once a few close values shrank the estimate. The
+    threshold is therefore the Student t prediction interval of n values that leaves out the same
+    share as kappa standard deviations of a normal distribution (0.27% for kappa=3). Accumulators
+    of disjoint parts of a sequence are combined with merge(), which is how worker processes hand
+    back their results.
+    """
+
+    def __init__(self, shape: tuple, kappa: float=3.0, min_count: int=5):
+        """
+        params
+        ------
+        shape: tuple
+            Shape of the frames
+        kappa: float | None, optional
+            Rejection threshold in standard deviations, None disables clipping, default to 3
+        min_count: int, optional
+            Number of values a pixel needs before clipping starts, at least 2, default to 5
+        """
+
+        self.kappa = kappa
+        self.min_count = max(min_count, 2)
+        self.thresholds = np.zeros(0)
+
+        self.sum = np.zeros(shape, dtype=np.float64)
+        self.sumsq = np.zeros(shape, dtype=np.float64)
+        self.count = np.zeros(shape, dtype=np.int32)
+        self.frames = 0
+        self.rejected = 0
+
+    def add(self, data: np.ndarray):
+        """
+        Add an aligned frame, NaN pixels (not covered by the frame) are skipped.
+        """
+
+        data = np.asarray(data, dtype=np.float64)
+        valid = np.isfinite(data)
+
+        if self.kappa is not None:
+            count = np.maximum(self.count, 2)
+            mean = self.sum / count
+            variance = (self.sumsq - self.sum * mean) / (count - 1)
+
+            with np.errstate(invalid="ignore"):
+                accepted = (self.count < self.min_count) | ((data - mean) ** 2 <= self.threshold(count) ** 2 * variance)
+
+            self.rejected += int(np.count_nonzero(valid & ~accepted))
+            valid &= accepted
+
+        np.add(self.sum, data, out=self.sum, where=valid)
+        np.add(self.sumsq, data * data, out=self.sumsq, where=valid)
+        self.count += valid
+        self.frames += 1
+
+    def threshold(self, count: np.ndarray):
+        """
+        Distance from the mean, in standard deviations of count values, beyond which a new value is rejected.
+
+        return
+        ------
+        np.ndarray
+            Threshold of every pixel, looked up from a table by number of values
+        """
+
+        size = int(count.max()) + 1
+
+        if size > len(self.thresholds):
+            n = np.arange(2, size, dtype=np.float64)
+            # two-sided share of a normal distribution beyond kappa
+            tail = 2 * ndtr(-self.kappa)
+            self.thresholds = np.concatenate(([np.inf, np.inf], stdtrit(n - 1, 1 - tail / 2) * np.sqrt(1 + 1 / n)))
+
+        return self.thresholds[count]
+
+    def copy(self):
+        """
+        Independent copy of the accumulator.
+        """
+
+        accumulator = StackAccumulator(self.sum.shape, self.kappa, self.min_count)
+        accumulator.merge(self)
+
+        return accumulator
+
+    def merge(self, other: "StackAccumulator", base: "StackAccumulator"=None):
+        """
+        Add the sums of another accumulator of the same shape to this one.
+
+        params
+        ------
+        other: StackAccumulator
+            Accumulator to be merged
+        base: StackAccumulator, optional
+            Accumulator other started as a copy of, only what other accumulated beyond it is added
+        """
+
+        for accumulator, sign in ((other, 1), (base, -1)) if base is not None else ((other, 1),):
+            self.sum += sign * accumulator.sum
+            self.sumsq += sign * accumulator.sumsq
+            self.count += sign * accumulator.count
+            self.frames += sign * accumulator.frames
+            self.rejected += sign * accumulator.rejected
+
+        return self
+
+    def mean(self, fill: float=0.0):
+        """
+        Stacked image, pixels no frame covered are set to fill.
+        """
+
+        return np.divide(self.sum, self.count, out=np.full(self.sum.shape, fill, dtype=np.float64), where=self.count > 0)
+
+def stack_chunk(frames: list, matrices: list[np.ndarray], kappa: float, min_count: int, seed: StackAccumulator=None):
+    """
+    Align and accumulate part of a sequence.
+
+    Module-level so it can run in worker processes.
+
+    params
+    ------
+    frames: list[str | np.ndarray]
+        Paths to FITS files, or image data of frames that only live in memory
+    matrices: list[np.ndarray]
+        3x3 matrices of the transforms mapping each frame onto the reference
+    kappa, min_count
+        See StackAccumulator
+    seed: StackAccumulator, optional
+        Accumulator to continue from, it is left unmodified
+
+    return
+    ------
+    StackAccumulator
+        Accumulated sums of the frames
+    """
+
+    accumulator = seed.copy() if seed is not None else None
+
+    for frame, matrix in zip(frames, matrices):
+        if isinstance(frame, str):
+            with Fits(frame, lazy=True) as fits_img:
+                data = np.asarray(fits_img.get_data())
+        else:
+            data = frame
+
+        # NaN marks the pixels the frame does not cover
+        aligned = warp_data(data, SimilarityTransform(matrix=matrix), np.nan)
+
+        if accumulator is None:
+            accumulator = StackAccumulator(aligned.shape, kappa, min_count)
+        accumulator.add(aligned)
+
+    return accumulator
+
+def stack_fits(fits_files: list[Fits], transforms: list, output_file: str, kappa: float=3.0, min_count: int=5, jobs: int=1):
+    """
+    Align a sequence of calibrated frames and mean-stack them with online sigma clipping.
+
+    Each frame is warped onto the reference and added straight into running sums
+    (StackAccumulator), so only one aligned frame per worker exists at a time. With several jobs
+    the first min_count frames are accumulated up front, so every worker clips against them from
+    its first frame on. The rest of the sequence is split into contiguous chunks, each accumulated
+    by a worker process on top of those first frames, and the partial sums are merged at the end.
+    Frames that match their file (Fits.matches_file) are read by the workers, any other is sent to them.
+
+    params
+    ------
+    fits_files: list[Fits]
+        Calibrated frames (one channel or luminance) to be stacked
+    transforms: list[SimilarityTransform]
+        Transforms mapping each frame onto the reference, from BatchAligner or TranslationAligner
+    output_file: str
+        Path to where the output is going to be written
+    kappa: float | None, optional
+        Rejection threshold in standard deviations, None disables clipping, default to 3
+    min_count: int, optional
+        Number of values a pixel needs before clipping starts, default to 5
+    jobs: int, optional
+        Number of worker processes, default to 1 (no pool)
+
+    return
+    ------
+    Fits
+        Newly created Fits object with the stacked data, pixels no frame covered are 0
+    """
+
+    # Get a copy of header to retain information from original FITS
+    header_copy = fits_files[0].header.copy()
+    matrices = [transform.params for transform in transforms]
+
+    if jobs > 1 and len(fits_files) > min_count + 1:
+        seed = stack_chunk((np.asarray(fits_img.get_data()) for fits_img in fits_files[:min_count]), matrices[:min_count], kappa, min_count)
+
+        frames = [fits_img.path if fits_img.matches_file else np.asarray(fits_img.get_data()) for fits_img in fits_files[min_count:]]
+        chunks = [chunk for chunk in np.array_split(np.arange(len(frames)), jobs) if len(chunk)]
+        count = len(chunks)
+
+        with ProcessPoolExecutor(max_workers=jobs, mp_context=helperfunc.process_context()) as executor:
+            partials = list(executor.map(stack_chunk, [[frames[i] for i in chunk] for chunk in chunks],
+                                         [[matrices[min_count + i] for i in chunk] for chunk in chunks],
+                                         [kappa] * count, [min_count] * count, [seed] * count))
+
+        accumulator = seed.copy()
+        for partial in partials:
+            accumulator.merge(partial, base=seed)
+    else:
+        frames = (np.asarray(fits_img.get_data()) for fits_img in fits_files)
+        accumulator = stack_chunk(frames, matrices, kappa, min_count)
+
+    print(f"Stacked {accumulator.frames} frames, {accumulator.rejected} pixel values rejected")
+
+    header_copy["NCOMBINE"] = accumulator.frames
+
+    return Fits.filecreate(output_file, accumulator.mean(), header_copy)
@@ -0,0 +1,40 @@
+import numpy as np
+from astropy.io import fits
+
+from src.module import darkprocessing
+from src.util.Fits import Fits
+
+def test_select_median_matches_numpy():
+    rng = np.random.default_rng(0)
+
+    # odd and even frame counts, native and big-endian (FITS) data, integers
+    for frames in (1, 2, 3, 4, 7, 8):
+        for dtype in (np.float32, np.float64, ">f4", np.int16, ">u2"):
+            block = rng.normal(1000, 20, (frames, 30, 40)).astype(dtype)
+
+            assert np.array_equal(darkprocessing.select_median(block), np.median(block, axis=0))
+
+def test_select_median_nan():
+    rng = np.random.default_rng(1)
+
+    for frames in (3, 4):
+        block = rng.normal(1000, 20, (frames, 30, 40))
+        block[rng.integers(0, frames, 50), rng.integers(0, 30, 50), rng.integers(0, 40, 50)] = np.nan
+
+        median = darkprocessing.select_median(block)
+
+        assert np.isnan(median).any()
+        assert np.array_equal(median, np.median(block, axis=0), equal_nan=True)
+
+def test_median_stack_fits_strips(tmp_path):
+    # stacking strip by strip gives the median of the whole cube
+    rng = np.random.default_rng(2)
+    paths = []
+    for i in range(6):
+        paths.append(str(tmp_path / f"dark{i}.fits"))
+        fits.writeto(paths[-1], rng.normal(1000, 20, (50, 40)).astype(">f4"))
+
+    frames = [Fits(path, lazy=True) for path in paths]
+    stacked = darkprocessing.median_stack_fits(frames, str(tmp_path / "master.fits"), memory_budget=3 * 6 * 40 * 4 * 7)
+
+    assert np.array_equal(stacked.get_data(), np.median([fits.getdata(path) for path in paths], axis=0))
@@ -0,0 +1,88 @@
+import os
+
+import numpy as np
+from astropy.io import fits
+
+from src.module.masterprocessing import MasterBuilder
+from src.util.Fits import Fits
+
+# a few rows per strip, so updates take several strips
+BUDGET = 30 * 200
+
+def write_frames(directory, count):
+    rng = np.random.default_rng(0)
+    paths = []
+    for i in range(count):
+        paths.append(str(directory / f"frame{i}.fits"))
+        fits.writeto(paths[-1], rng.normal(1000, 5, (40, 30)).astype(">f4"))
+    return paths
+
+def frames(paths):
+    return [Fits(path, lazy=True) for path in paths]
+
+def test_master_builder_matches_batch(tmp_path):
+    paths = write_frames(tmp_path, 6)
+    builder = MasterBuilder(str(tmp_path / "master"), memory_budget=BUDGET)
+
+    builder.add(frames(paths[:4]))
+    builder.add(frames(paths[4:]))
+    builder.remove(frames(paths[1:2]))
+
+    stack = np.array([fits.getdata(path) for path in paths[:1] + paths[2:]], dtype=np.float64)
+
+    assert sorted(builder.frames) == sorted(paths[:1] + paths[2:])
+    assert np.allclose(builder.mean(), stack.mean(axis=0))
+    assert np.allclose(builder.variance(), stack.var(axis=0, ddof=1))
+
+def interrupted_add(tmp_path, paths, fail):
+    """
+    Add paths[2:] to a master holding paths[:2], interrupted where fail(step, steps) says so, then reopen it.
+    """
+
+    directory = str(tmp_path / "master")
+    MasterBuilder(directory, memory_budget=BUDGET).add(frames(paths[:2]))
+
+    steps = {"count": 0}
+    save_manifest, remove = MasterBuilder.save_manifest, os.remove
+
+    def failing_save(self):
+        if self.pending is not None and self.pending["next_row"] > 0 and fail("manifest", steps):
+            raise KeyboardInterrupt
+        save_manifest(self)
+
+    def failing_remove(path):
+        if path.endswith(MasterBuilder.JOURNAL) and fail("journal", steps):
+            raise KeyboardInterrupt
+        remove(path)
+
+    MasterBuilder.save_manifest, os.remove = failing_save, failing_remove
+    try:
+        MasterBuilder(directory, memory_budget=BUDGET).add(frames(paths[2:]))
+        raise AssertionError("the update was not interrupted")
+    except KeyboardInterrupt:
+        pass
+    finally:
+        MasterBuilder.save_manifest, os.remove = save_manifest, remove
+
+    # reopening finishes the interrupted update
+    return MasterBuilder(directory, memory_budget=BUDGET)
+
+def test_master_builder_resume(tmp_path):
+    paths = write_frames(tmp_path, 5)
+    stack = np.array([fits.getdata(path) for path in paths], dtype=np.float64)
+
+    # after the strip was copied but before the manifest recorded it, and before the journal was dropped
+    for where in ("manifest", "journal"):
+        for strip in (1, 3):
+            def fail(step, steps):
+                if step != where:
+                    return False
+                steps["count"] += 1
+                return steps["count"] == strip
+
+            builder = interrupted_add(tmp_path / f"{where}{strip}", paths, fail)
+
+            assert builder.pending is None
+            assert len(builder.frames) == 5
+            assert np.all(np.asarray(builder.statistic("count")) == 5)
+            assert np.allclose(builder.mean(), stack.mean(axis=0))
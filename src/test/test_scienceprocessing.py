@@ -0,0 +1,42 @@
+import numpy as np
+
+from src.module.scienceprocessing import StackAccumulator
+
+def test_stack_accumulator_noise_rejection():
+    # pure Gaussian noise is rejected at about the nominal rate of kappa=3 (0.27%)
+    rng = np.random.default_rng(0)
+    accumulator = StackAccumulator((100, 100), kappa=3.0)
+
+    for _ in range(30):
+        accumulator.add(rng.normal(100, 5, (100, 100)))
+
+    checked = (accumulator.frames - accumulator.min_count) * accumulator.count.size
+    assert 0.001 < accumulator.rejected / checked < 0.006
+
+    # no pixel gets locked to its first values
+    assert np.mean(accumulator.count <= 15) < 0.001
+
+def test_stack_accumulator_rejects_outliers():
+    rng = np.random.default_rng(1)
+    accumulator = StackAccumulator((100, 100), kappa=3.0)
+
+    for i in range(20):
+        data = rng.normal(100, 5, (100, 100))
+        if i >= 8:
+            data[::10, ::10] += 100     # cosmic rays
+        accumulator.add(data)
+
+    assert abs(accumulator.mean()[::10, ::10].mean() - 100) < 1
+
+def test_stack_accumulator_merge():
+    rng = np.random.default_rng(2)
+    frames = [rng.normal(100, 5, (20, 30)) for _ in range(6)]
+
+    whole = StackAccumulator((20, 30), kappa=None)
+    first, second = StackAccumulator((20, 30), kappa=None), StackAccumulator((20, 30), kappa=None)
+    for i, data in enumerate(frames):
+        whole.add(data)
+        (first if i < 3 else second).add(data)
+
+    assert np.allclose(first.merge(second).mean(), whole.mean())
+    assert np.allclose(whole.mean(), np.mean(frames, axis=0))
@@ -1,5 +1,6 @@
 # tests can go here, or not doesn't really matter
 import timeit
+import numpy as np
 
 from src.module import darkprocessing, flatprocessing, scienceprocessing
 from src.util.Fits import *
@@ -231,6 +232,44 @@ def align_test():
 
     pass
 
+def demosaic_bench():
+    # compare the strided-slice demosaic against the convolution one on a full-size synthetic mosaic
+    data = np.random.default_rng(0).integers(0, 65535, (4000, 6000)).astype(np.uint16)
+
+    start = time()
+    flatprocessing.extract_rgb_optimized(data.astype(float), "RGGB")
+    convolve_time = time() - start
+
+    start = time()
+    flatprocessing.demosaic_bilinear(data, "RGGB")
+    bilinear_time = time() - start
+
+    start = time()
+    flatprocessing.demosaic_bilinear(data, "RGGB", np.float32)
+    bilinear32_time = time() - start
+
+    print(f"extract_rgb_optimized: {convolve_time:.3f}s")
+    print(f"demosaic_bilinear:     {bilinear_time:.3f}s ({convolve_time / bilinear_time:.1f}x)")
+    print(f"demosaic_bilinear f32: {bilinear32_time:.3f}s ({convolve_time / bilinear32_time:.1f}x)")
+
+def median_bench():
+    # compare select_median against np.median on a strip-sized stack of an even number of frames
+    rng = np.random.default_rng(0)
+
+    for dtype in (np.uint16, np.float32, np.float64):
+        cube = rng.normal(1000, 30, (30, 500, 6000)).astype(dtype)
+
+        start = time()
+        expected = np.median(cube, axis=0)
+        numpy_time = time() - start
+
+        start = time()
+        result = darkprocessing.select_median(cube)
+        select_time = time() - start
+
+        print(f"{np.dtype(dtype).name:>7} np.median: {numpy_time:.3f}s  select_median: {select_time:.3f}s "
+              f"({numpy_time / select_time:.1f}x, identical: {np.array_equal(expected, result)})")
+
 def siril_test():
     
     pass
@@ -244,4 +283,6 @@ if __name__ == "__main__":
     # random_test()
     # output_test()
     align_test()
+    # demosaic_bench()
+    # median_bench()
     # siril_test()
@@ -0,0 +1,156 @@
+from astropy.io import fits
+import hashlib
+import os
+
+from src.util.Fits import *
+from src.util.Constant import *
+
+class CalibrationCache:
+    """
+    Disk cache of master calibration frames and their per-channel RGB splits.
+
+    Entries are keyed by a fingerprint of the input frames (path, size and modification time
+    of each) and the parameters used to build the master, so a master is only rebuilt when its
+    inputs or the way it is built change. Every entry is a single multi-extension FITS file:
+    the master in the primary HDU followed by what was derived from it, typically its red, 
+    green and blue channels. The cache is kept under a size limit by evicting the least 
+    recently used entries.
+    """
+
+    # header keyword remembering the path of each cached Fits object
+    PATH_KEY = "CACHEPTH"
+
+    def __init__(self, cache_dir: str=Constant.CACHE_PATH, max_bytes: int=2 * 1024 ** 3):
+        """
+        params
+        ------
+        cache_dir: str, optional
+            Directory where the cached masters are stored
+        max_bytes: int, optional
+            Size limit of the cache directory in bytes, default to 2 GiB
+        """
+
+        self.cache_dir = cache_dir.replace("\\", "/").rstrip("/")
+        self.max_bytes = max_bytes
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    @staticmethod
+    def fingerprint(fits_files: list[Fits], **params):
+        """
+        Static method to compute the cache key of a master built from given frames.
+
+        params
+        ------
+        fits_files: list[Fits]
+            Frames the master is built from
+        **params
+            Anything else the master depends on (stacking method, key of the master dark, ...)
+
+        return
+        ------
+        str
+            Hex digest identifying the frame set and parameters
+        """
+
+        digest = hashlib.sha256()
+
+        for path in sorted(fits_file.path for fits_file in fits_files):
+            stat = os.stat(path)
+            digest.update(f"{path}\0{stat.st_size}\0{stat.st_mtime_ns}\n".encode())
+
+        for key in sorted(params):
+            digest.update(f"{key}={params[key]!r}\n".encode())
+
+        return digest.hexdigest()
+
+    def entry_path(self, key: str):
+        """
+        Path of the cache file for given key.
+        """
+
+        return f"{self.cache_dir}/{key}.fits"
+
+    def load(self, key: str):
+        """
+        Load cached master frames.
+
+        params
+        ------
+        key: str
+            Key from fingerprint()
+
+        return
+        ------
+        list[Fits] | None
+            The cached Fits objects with the paths they had when stored, or None when not cached
+        """
+
+        entry = self.entry_path(key)
+
+        if not os.path.isfile(entry):
+            return None
+
+        frames = []
+
+        with fits.open(entry) as hdul:
+            for hdu in hdul:
+                # extension headers turn back into primary headers in filecreate, like every other Fits object
+                header = hdu.header.copy()
+                path = header.pop(self.PATH_KEY)
+                frames.append(Fits.filecreate(path, hdu.data, header))
+
+        # bump modification time, it is the recency used for eviction
+        os.utime(entry)
+        print(f"Loaded cached {', '.join(frame.path for frame in frames)} from {entry}")
+
+        return frames
+
+    def store(self, key: str, frames: list[Fits]):
+        """
+        Store master frames under one key, evicting old entries if the cache grows past its limit.
+
+        params
+        ------
+        key: str
+            Key from fingerprint()
+        frames: list[Fits]
+            Master frame and anything derived from it (e.g. its red, green and blue channels)
+        """
+
+        entry = self.entry_path(key)
+
+        hdul = fits.HDUList()
+        for i, frame in enumerate(frames):
+            hdu_type = fits.PrimaryHDU if i == 0 else fits.ImageHDU
+            hdu = hdu_type(data=frame.get_data(), header=frame.header)
+            hdu.header[self.PATH_KEY] = frame.path
+            hdul.append(hdu)
+
+        # write next to the entry and move it in place, so an interrupted write never leaves a broken entry
+        hdul.writeto(entry + ".tmp", overwrite=True, output_verify="silentfix")
+        os.replace(entry + ".tmp", entry)
+        print(f"Cached {', '.join(frame.path for frame in frames)} in {entry}")
+
+        self.evict()
+
+    def evict(self):
+        """
+        Remove least recently used entries until the cache fits in its size limit.
+        """
+
+        entries = []
+        with os.scandir(self.cache_dir) as files:
+            for file in files:
+                if file.is_file() and file.name.endswith(".fits"):
+                    stat = file.stat()
+                    entries.append((stat.st_mtime, stat.st_size, file.path))
+
+        total = sum(size for _, size, _ in entries)
+
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            os.remove(path)
+            total -= size
+            print(f"Evicted cached master {path}")
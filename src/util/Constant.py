@@ -12,6 +12,7 @@ class Constant:
         TYPE_KEY = ["TARGET", "OBJECT"]
 
         BAYER_KEY = "BAYERPAT"
+        FILTER_KEY = "FILTER"
     
 
 
@@ -19,6 +20,10 @@ class Constant:
     RESOURCE_PATH = r"resource/"
     OUTPUT_PATH = r"resource/output/"
     PNG_PATH = r"resource/output/image_png/"
+    PREVIEW_PATH = r"resource/output/preview/"
+    INDEX_PATH = r"resource/header_index.db"
+    CACHE_PATH = r"resource/cache/"
+    TRANSFORM_CACHE_PATH = r"resource/cache/transforms/"
 
     DARK_PATH = r"resource/dark_images/"
     FLAT_PATH = r"resource/flat_images/"
@@ -1,26 +1,230 @@
 from astropy.io import fits
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+import hashlib
+import threading
 import numpy as np
 import os
 
 from src.util.Constant import *
+from src.util.Precision import *
+
+class HandlePool:
+    """
+    Least recently used pool of lazily opened Fits objects.
+
+    Lazy Fits objects register here whenever their file handle is used. Once more than
+    the allowed number of handles are open, the least recently used Fits object gets
+    closed; it reopens on its own the next time it is accessed.
+
+    Code that cycles through the same frames over and over (e.g. stacking strip by strip)
+    declares them with working_set(), otherwise every frame would be evicted right before
+    it is needed again once there are more frames than max_open.
+    """
+
+    def __init__(self, max_open: int):
+        self.max_open = max_open
+        self.working_sets = []
+        self.open_files = OrderedDict()
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def handle_limit():
+        """
+        Static method giving the number of handles the pool may hold at most, half of what the process is allowed to open.
+        """
+
+        try:
+            import resource
+        except ImportError:
+            return 4096     # Windows has no resource module, the C runtime allows 8192 open files
+
+        soft, _ = resource.getrlimit(resource.RLIMIT_NOFILE)
+        return max(64, soft // 2) if soft != resource.RLIM_INFINITY else 4096
+
+    def limit(self):
+        """
+        Number of handles currently allowed, raised by the working sets in use.
+        """
+
+        return max([self.max_open] + self.working_sets)
+
+    @contextmanager
+    def working_set(self, size: int):
+        """
+        Keep up to size handles open inside a with block, so that many lazy Fits objects stay open
+        while they are visited repeatedly. Prints a warning when the handle limit of the process
+        is too low for them, the files then get reopened on every visit.
+
+        params
+        ------
+        size: int
+            Number of Fits objects visited repeatedly in the block
+        """
+
+        limit = HandlePool.handle_limit()
+
+        if size > limit:
+            print(f"Warning: {size} files are visited repeatedly but only {limit} can stay open, they will be reopened on every visit")
+
+        with self.lock:
+            self.working_sets.append(min(size, limit))
+        try:
+            yield self
+        finally:
+            with self.lock:
+                self.working_sets.remove(min(size, limit))
+            self.trim()
+
+    def trim(self):
+        """
+        Close the least recently used handles beyond the current limit.
+        """
+
+        evicted = []
+
+        with self.lock:
+            while len(self.open_files) > self.limit():
+                evicted.append(self.open_files.popitem(last=False)[1])
+
+        for oldest in evicted:
+            oldest.close()
+
+    def touch(self, fits_obj: "Fits"):
+        """
+        Mark the handle of a Fits object as most recently used, closing the oldest handles if needed.
+        """
+
+        with self.lock:
+            self.open_files[id(fits_obj)] = fits_obj
+            self.open_files.move_to_end(id(fits_obj))
+
+        self.trim()
+
+    def discard(self, fits_obj: "Fits"):
+        """
+        Stop tracking a Fits object, typically because its handle was closed.
+        """
+
+        with self.lock:
+            self.open_files.pop(id(fits_obj), None)
 
 class Fits:
     """
     Class to handle FITS files.
     
-    Current implementation opens FITS header upon initialization 
-    to avoid repeated open() which in turn improves performance, 
-    assuming memory is of no concern. Otherwise, change class to 
-    implement lazy-loading.
+    By default the FITS file is opened upon initialization to avoid 
+    repeated open() which in turn improves performance, assuming 
+    memory and file handles are of no concern.
+
+    In lazy mode nothing is opened upon initialization. The header is 
+    parsed when first needed, data is read (memory-mapped when possible) 
+    on first access, and the file handle is released either explicitly 
+    through close() / a with block, or by the shared pool once too many 
+    lazy files are open. Released files reopen transparently.
     """
+
+    # shared pool limiting the number of file handles held by lazy Fits objects
+    pool = HandlePool(max_open=64)
+
+    # FITS files are made of 2880-byte blocks, headers of 80-character cards
+    BLOCK_SIZE = 2880
+    CARD_SIZE = 80
     
-    def __init__(self, path: str=None):
+    def __init__(self, path: str=None, lazy: bool=False):
         self.path = None
-        self.hdul = None
+        self.lazy = lazy
+
+        self._hdul = None
+        self._header = None
+        self._on_disk = False     # True while the contents can be re-read from self.path
+        self.storage = None       # storage type used by diskwrite, Precision.storage when None
         
         if (path):
             self.set(path)
-    
+
+    def __enter__(self):
+        return self.open()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    @property
+    def hdul(self):
+        """
+        HDU list of the FITS file, opened on demand for lazy Fits objects.
+        """
+
+        if self._hdul is None and self._on_disk:
+            return self.open()._hdul
+
+        if self.lazy and self._on_disk:
+            Fits.pool.touch(self)
+        return self._hdul
+
+    @property
+    def is_file_backed(self):
+        """
+        True while the contents of the Fits object can be re-read from self.path, i.e. it was
+        loaded from a file and none of its data has been replaced with set_data since.
+        """
+
+        return self._on_disk
+
+    @property
+    def matches_file(self):
+        """
+        True while the Fits object provably holds what its file does: it is file-backed and none
+        of its data has been read yet (data in memory may have been changed in place).
+        """
+
+        return self._on_disk and (self._hdul is None or not any(hdu._data_loaded for hdu in self._hdul))
+
+    @property
+    def header(self):
+        """
+        Header of the primary HDU, parsed on demand without reading the data for lazy Fits objects.
+        """
+
+        if self._hdul is not None:
+            return self._hdul[0].header
+
+        if self._header is None and self._on_disk:
+            self._header = fits.getheader(self.path)
+        return self._header
+
+    def open(self):
+        """
+        Open the file handle of a Fits object that points to a file on disk. Safe to call when already open.
+
+        return
+        ------
+        Fits
+            The Fits object itself, so it can be used as `with fits_obj.open():`
+        """
+
+        if self._hdul is None and self._on_disk:
+            self._hdul = fits.open(self.path)
+
+        if self.lazy and self._on_disk:
+            Fits.pool.touch(self)
+        return self
+
+    def close(self):
+        """
+        Release the file handle and any data read from it. 
+        
+        Fits objects whose data only lives in memory (newly created or modified ones) 
+        are left untouched, since closing them would lose the data.
+        """
+
+        Fits.pool.discard(self)
+
+        if self._hdul is not None and self._on_disk:
+            self._hdul.close()
+            self._hdul = None
+
     # TODO: Handle the case when creating a new FITS object from a newly created FITS data is assigned 
     #       to an existing path. For now, just dont't be dumb and make sure the path is for its own.
     def set(self, path: str, hdu: fits.PrimaryHDU=None):
@@ -37,14 +241,23 @@ class Fits:
     
         # change windows path to POSIX, for consistency sake
         format_path = path.replace("\\", "/")
+
+        # drop whatever this object was holding before
+        self.close()
+        self._hdul = None
+        self._header = None
         
-        # if given path points to existing FITS file, open HDUL
+        # if given path points to existing FITS file, open HDUL (lazy objects wait until needed)
         if (self.check_path(format_path)) and not hdu:
             self.path = format_path
-            self.hdul = fits.open(format_path)
+            self._on_disk = True
+
+            if not self.lazy:
+                self._hdul = fits.open(format_path)
         elif hdu:
             self.path = format_path
-            self.hdul = fits.HDUList([hdu])
+            self._on_disk = False
+            self._hdul = fits.HDUList([hdu])
         else:
             raise FileNotFoundError(f"Provided path {format_path} is not a FITS file")
 
@@ -67,13 +280,40 @@ class Fits:
             Bayer pattern of Fits object
         """
 
-        header = self.hdul[0].header
+        header = self.header
 
         if header.get(Constant.HeaderObj.BAYER_KEY) is not None:
             return header[Constant.HeaderObj.BAYER_KEY]
         
         raise ValueError(f"{Constant.HeaderObj.BAYER_KEY} not found in FITS header.")
 
+    def fingerprint(self):
+        """
+        Identify the contents of the Fits object.
+
+        Objects that match their file (see matches_file) are identified by path, size and
+        modification time, any other (data replaced with set_data, or read and possibly changed
+        in place) by a hash of its data.
+
+        return
+        ------
+        str
+            Hex digest of the contents
+        """
+
+        digest = hashlib.sha256()
+
+        if self.matches_file:
+            stat = os.stat(self.path)
+            digest.update(f"{self.path}\0{stat.st_size}\0{stat.st_mtime_ns}\n".encode())
+        else:
+            for data in self.channel_data():
+                data = np.ascontiguousarray(data)
+                digest.update(f"{data.dtype.str}{data.shape}\n".encode())
+                digest.update(data.view(np.uint8))
+
+        return digest.hexdigest()
+
     def get_data(self, index: int = 0):
         """
         Retrieve data from selected HDU.
@@ -92,7 +332,57 @@ class Fits:
         if (index < 0):
             raise IndexError("Invalid negative index")
         return self.hdul[index].data
-    
+
+    def get_rows(self, start: int, stop: int, index: int = 0):
+        """
+        Retrieve a strip of rows from selected HDU without loading the whole image.
+
+        If the data of the HDU has not been read yet, only the requested rows are read from
+        the file through astropy's section access (scaling keywords are still applied).
+        Otherwise the rows are sliced from the data already in memory.
+
+        params
+        ------
+        start: int
+            First row of the strip
+        stop: int
+            Row after the last row of the strip
+        index: int, optional
+            The index of the HDU from which data is to be pulled from. Default is 0 (primary HDU)
+
+        return
+        ------
+        np.ndarray
+            The rows [start, stop) of the selected HDU
+        """
+
+        if (index < 0):
+            raise IndexError("Invalid negative index")
+
+        hdu = self.hdul[index]
+
+        if hdu._data_loaded:
+            return hdu.data[start:stop]
+        return hdu.section[start:stop]
+
+    def shape(self, index: int = 0):
+        """
+        Get image dimension from the header, without reading the data.
+
+        params
+        ------
+        index: int, optional
+            The index of the HDU. Default is 0 (primary HDU)
+
+        return
+        ------
+        tuple
+            Shape of the image data in numpy order (rows, columns)
+        """
+
+        header = self.header if index == 0 else self.hdul[index].header
+        return tuple(header[f"NAXIS{axis}"] for axis in range(header["NAXIS"], 0, -1))
+
     def set_data(self, data: np.ndarray, index: int=0):
         """
         Set new data for a specified HDU in the FITS file.
@@ -107,10 +397,20 @@ class Fits:
 
         if index < 0 or index >= len(self.hdul):
             raise IndexError(f"Invalid HDU index {index}.")
-        self.hdul[index].data = data
+
+        if self._on_disk:
+            # the data now only lives in memory: read the rest of the file and let go of the handle,
+            # so neither close() nor the pool can drop the new data, and nothing re-reads the file
+            for hdu in self._hdul:
+                hdu.data
+            Fits.pool.discard(self)
+            self._hdul.close()
+            self._on_disk = False
+
+        self._hdul[index].data = data
         print(f"Data successfully set for HDU index {index} in FITS file {self.path}")
     
-    def diskwrite(self, overwrite: bool = True):
+    def diskwrite(self, overwrite: bool = True, storage: str = None):
         """
         Write the current HDU list to a FITS file.
 
@@ -118,13 +418,44 @@ class Fits:
         ------
         overwrite: bool, optional
             Flag to overwrite existing files, default to True
+        storage: str, optional
+            Storage type the data is written with (see Precision), defaults to the storage type
+            of this Fits object, then to Precision.storage, then to the type of the data
         """
 
-        fits.writeto(filename=self.path, data=self.get_data(), header=self.hdul[0].header, overwrite=overwrite)
+        storage = storage or self.storage or Precision.storage
+
+        # astropy byteswaps native arrays in place while writing them and swaps them back after,
+        # other threads reading the data in the meantime (e.g. with a FitsWriter) would see
+        # swapped values. Given read-only views, astropy writes from a swapped copy instead
+        if len(self.hdul) > 1:
+            # multi-extension file (e.g. from channelcreate), every image HDU keeps its type, name and compression
+            hdus = []
+            for hdu in self.hdul:
+                if hdu.is_image and hdu.data is not None:
+                    kwargs = {"compression_type": hdu.compression_type} if isinstance(hdu, fits.CompImageHDU) else {}
+                    hdu = Precision.storage_hdu(Fits.readonly_view(hdu.data), hdu.header, storage, type(hdu), **kwargs)
+                hdus.append(hdu)
+            fits.HDUList(hdus).writeto(self.path, overwrite=overwrite)
+        else:
+            Precision.storage_hdu(Fits.readonly_view(self.get_data()), self.hdul[0].header, storage).writeto(self.path, overwrite=overwrite)
         print(f"FITS file succesfully written to {self.path}")
 
     @staticmethod
-    def filecreate(path: str, data: list, header: fits.Header=None):
+    def readonly_view(data: np.ndarray):
+        """
+        Static method returning a read-only view of data (None stays None), the data itself stays writeable.
+        """
+
+        if data is None:
+            return None
+
+        view = np.asarray(data).view()
+        view.flags.writeable = False
+        return view
+
+    @staticmethod
+    def filecreate(path: str, data: list, header: fits.Header=None, storage: str=None):
         """
         Static method to write data into new FITS file or overwrite existing FITS file given in path.
 
@@ -136,6 +467,9 @@ class Fits:
             List of data that will be stored in this file
         header: fits.Header
             Header of a FITS file with information to be carried over
+        storage: str, optional
+            Storage type the data gets written with by diskwrite (see Precision), the data
+            is kept as it is in memory
         
         return
         ------
@@ -145,8 +479,117 @@ class Fits:
         
         new_obj = Fits()
         new_obj.set(path, fits.PrimaryHDU(data=data, header=header))
+        new_obj.storage = storage
         return new_obj
 
+    @staticmethod
+    def channelcreate(path: str, channels: list, header: fits.Header=None, layout: str="mef", compression: str=None, storage: str=None):
+        """
+        Static method to put the color channels of a frame into one new FITS file, instead of one file per channel.
+
+        params
+        ------
+        path: str
+            Path to where FITS is to be written to
+        channels: list[Fits]
+            Red, green and blue channels (or any number of equally sized planes)
+        header: fits.Header, optional
+            Header of a FITS file with information to be carried over, put in the primary HDU
+        layout: str, optional
+            "mef" for one image extension per channel named RED, GREEN and BLUE after an empty
+            primary HDU, or "cube" for a single (channels, rows, columns) image
+        compression: str, optional
+            Tile compression of the images ("RICE_1", "GZIP_1", "GZIP_2", ...), None for none.
+            Floating point data is quantized by the compression, keep integer storage for lossless files
+        storage: str, optional
+            Storage type the data gets written with by diskwrite (see Precision)
+
+        return
+        ------
+        Fits
+            Creates a new Fits object with hdul and path, read back with channel_data()
+        """
+
+        datas = [np.asarray(channel.get_data()) for channel in channels]
+        image_type = fits.CompImageHDU if compression else fits.ImageHDU
+        kwargs = {"compression_type": compression} if compression else {}
+
+        if layout == "mef":
+            names = ("RED", "GREEN", "BLUE") if len(datas) == 3 else [f"CHANNEL{i}" for i in range(len(datas))]
+            images = [image_type(data=data, name=name, **kwargs) for data, name in zip(datas, names)]
+        elif layout == "cube":
+            images = [image_type(data=np.stack(datas), name="RGB", **kwargs)]
+        else:
+            raise ValueError(f"Invalid channel layout: {layout}")
+
+        # compressed images can't be primary, an uncompressed cube can
+        if layout == "cube" and not compression:
+            hdus = [fits.PrimaryHDU(data=images[0].data, header=header)]
+        else:
+            hdus = [fits.PrimaryHDU(header=header)] + images
+
+        new_obj = Fits()
+        new_obj.set(path, hdus[0])
+        for hdu in hdus[1:]:
+            new_obj._hdul.append(hdu)
+        new_obj.storage = storage
+        return new_obj
+
+    def channel_data(self):
+        """
+        Retrieve the data of each color channel.
+
+        Works for multi-channel files from channelcreate (one extension per channel or a cube) as
+        well as for plain single-channel files.
+
+        return
+        ------
+        list[np.ndarray]
+            2D data of every channel, in order (red, green, blue for color frames)
+        """
+
+        datas = [hdu.data for hdu in self.hdul if hdu.is_image and hdu.data is not None]
+
+        if len(datas) == 1 and datas[0].ndim == 3:
+            return list(datas[0])
+        return datas
+
+    @staticmethod
+    def read_header(path: str):
+        """
+        Static method to parse only the primary header of a FITS file.
+
+        Reads the file in 2880-byte FITS blocks up to the block holding the END card, so 
+        neither the data units nor any extensions are touched and the file is closed right away.
+
+        params
+        ------
+        path: str
+            Complete path to FITS file
+
+        return
+        ------
+        fits.Header
+            Primary header of the FITS file
+        """
+
+        raw = b""
+
+        with open(path, "rb") as file:
+            while True:
+                block = file.read(Fits.BLOCK_SIZE)
+
+                if len(block) < Fits.BLOCK_SIZE:
+                    raise OSError(f"File {path} ends before the END card of its primary header")
+
+                raw += block
+
+                # header cards are 80 characters long, the header stops at the END card
+                if any(block[i:i + Fits.CARD_SIZE].rstrip() == b"END" for i in range(0, Fits.BLOCK_SIZE, Fits.CARD_SIZE)):
+                    break
+
+        return fits.Header.fromstring(raw.decode("ascii"))
+
     @staticmethod
     def check_type(path: str):
         """
@@ -163,7 +606,7 @@ class Fits:
             Image type as string
         """
 
-        header = fits.open(path)[0].header
+        header = Fits.read_header(path)
 
         # Checks through list of "known" key values that stores the image type in the FITS file we handle
         for key in Constant.HeaderObj.TYPE_KEY:
@@ -193,9 +636,12 @@ class Fits:
         return False
 
     @staticmethod
-    def batchload(path: str, type: str="N/A"):
+    def scan(path: str, type: str="N/A", workers: int=None):
         """
-        Creates FITS object for every image found in given directory and return a list of FITS objects.
+        Find FITS files in given directory, optionally filtered by image type, without opening their data.
+
+        Files are checked on a thread pool and only the primary header block of each file is 
+        read for the type filter, which keeps directory scans fast on network-mounted storage.
 
         params
         ------
@@ -203,27 +649,69 @@ class Fits:
             Path to directory with FITS images
         type: str, optional
             Type of images to collect, default assumes that we are pulling everything in the given directory
+        workers: int, optional
+            Number of threads checking files, default to the ThreadPoolExecutor default
 
         return
         ------
         list
-            List of Fits objects
+            List of paths to the matching FITS files, in directory listing order
         """
 
         # change to POSIX format for consistency
         format_path = path.replace("\\", "/")
 
-        fits_list = []
+        if not os.path.isdir(format_path):
+            raise NotADirectoryError(f"Provided path {path} is not a directory")
+
+        def match(file_path: str):
+            if not Fits.check_path(file_path):
+                return False
+            return type == "N/A" or type == Fits.check_type(file_path)
+
+        candidates = [f"{format_path}/{files}" for files in os.listdir(format_path)]
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            matches = list(executor.map(match, candidates))
+
+        return [file_path for file_path, matched in zip(candidates, matches) if matched]
+
+    @staticmethod
+    def batchload(path: str, type: str="N/A", lazy: bool=False, workers: int=None, index=None):
+        """
+        Creates FITS object for every image found in given directory and return a list of FITS objects.
+
+        params
+        ------
+        path: str
+            Path to directory with FITS images
+        type: str, optional
+            Type of images to collect, default assumes that we are pulling everything in the given directory
+        lazy: bool, optional
+            Create lazy Fits objects that do not hold a file handle or data until accessed, 
+            needed for directories with more files than can be kept open at once
+        workers: int, optional
+            Number of threads scanning the directory and opening files, default to the ThreadPoolExecutor default
+        index: HeaderIndex, optional
+            Header index to look the files up in instead of scanning every header
 
-        if (os.path.isdir(path)):
-            for files in os.listdir(path):
-                if (Fits.check_path(f"{path}/{files}") and type == 'N/A') :
-                    fits_list.append(Fits(f"{path}/{files}"))
-                elif (Fits.check_path(f"{path}/{files}") and type == Fits.check_type(f"{path}/{files}")):
-                    fits_list.append(Fits(f"{path}/{files}"))
+        return
+        ------
+        list
+            List of Fits objects
+        """
 
-            print(f"Batch collect found {len(fits_list)} {type} files in {path}")
+        if index is not None:
+            file_paths = index.query(path, type, workers)
+        else:
+            file_paths = Fits.scan(path, type, workers)
 
-            return fits_list
+        if lazy:
+            fits_list = [Fits(file_path, lazy) for file_path in file_paths]
         else:
-            raise NotADirectoryError(f"Provided path {path} is not a directory")
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                fits_list = list(executor.map(Fits, file_paths))
+
+        print(f"Batch collect found {len(fits_list)} {type} files in {path}")
+
+        return fits_list
@@ -0,0 +1,132 @@
+import queue
+import threading
+
+from src.util.Fits import *
+
+class FitsWriter:
+    """
+    Background writer overlapping FITS writes with processing.
+
+    Fits objects handed to submit() are queued and written by writer threads with diskwrite(),
+    so the caller can move on to the next frame right away. The queue is bounded: once
+    max_pending objects are waiting, submit() blocks until a writer catches up, which keeps the
+    memory held by unwritten frames bounded. flush() waits for every queued write, close() also
+    stops the threads; both raise if any write failed, as does the next submit() after a failure.
+
+    Submitted Fits objects are written as they are when a writer gets to them, so they must not be
+    modified after being submitted. Reading them meanwhile is safe: diskwrite() hands astropy
+    read-only views, so the arrays are never byteswapped in place while other threads use them.
+    Writer threads are daemons, use the writer in a with block (or call close()) so queued
+    writes are not dropped when the program exits.
+    """
+
+    def __init__(self, workers: int=2, max_pending: int=8):
+        """
+        Start the writer threads.
+
+        params
+        ------
+        workers: int, optional
+            Number of writer threads, default to 2
+        max_pending: int, optional
+            Number of Fits objects that may wait to be written before submit() blocks, default to 8
+        """
+
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.errors = []
+        self.lock = threading.Lock()
+        self.closed = False
+
+        self.threads = [threading.Thread(target=self.run, name=f"FitsWriter-{i}", daemon=True) for i in range(workers)]
+        for thread in self.threads:
+            thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # don't hide the exception that ended the with block behind a write error
+        if exc_type is None:
+            self.close()
+        else:
+            self.stop()
+
+    def run(self):
+        """
+        Writer thread loop, writes queued Fits objects until it gets the stop sentinel (None).
+        """
+
+        while True:
+            fits_obj, overwrite = self.queue.get()
+
+            try:
+                if fits_obj is None:
+                    return
+                fits_obj.diskwrite(overwrite)
+            except Exception as error:
+                with self.lock:
+                    self.errors.append((fits_obj.path, error))
+            finally:
+                self.queue.task_done()
+
+    def raise_errors(self):
+        """
+        Raise the first write error recorded since the last call, if any.
+        """
+
+        with self.lock:
+            errors, self.errors = self.errors, []
+
+        if errors:
+            path, error = errors[0]
+            raise RuntimeError(f"Writing {len(errors)} FITS file(s) failed, first was {path}: {error}") from error
+
+    def submit(self, fits_obj: Fits, overwrite: bool=True):
+        """
+        Queue a Fits object to be written to its path, blocking while the queue is full.
+
+        params
+        ------
+        fits_obj: Fits
+            Fits object to be written, left unmodified until it is
+        overwrite: bool, optional
+            Flag to overwrite existing files, default to True
+        """
+
+        if self.closed:
+            raise RuntimeError("FitsWriter is closed")
+
+        # fail fast instead of computing frames that can't be written
+        self.raise_errors()
+
+        self.queue.put((fits_obj, overwrite))
+
+    def flush(self):
+        """
+        Wait until every submitted Fits object is written, raising if any write failed.
+        """
+
+        self.queue.join()
+        self.raise_errors()
+
+    def stop(self):
+        """
+        Let the writer threads finish the queued writes and exit, without raising write errors.
+        """
+
+        if self.closed:
+            return
+        self.closed = True
+
+        for _ in self.threads:
+            self.queue.put((None, None))
+        for thread in self.threads:
+            thread.join()
+
+    def close(self):
+        """
+        Write everything still queued and stop the writer threads, raising if any write failed.
+        """
+
+        self.stop()
+        self.raise_errors()
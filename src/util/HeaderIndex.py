@@ -0,0 +1,214 @@
+from concurrent.futures import ThreadPoolExecutor
+import sqlite3
+import os
+
+from src.util.Fits import *
+from src.util.Constant import *
+
+class HeaderIndex:
+    """
+    On-disk catalog of the FITS header keywords the pipeline filters frames by.
+
+    Every FITS file is recorded with its size and modification time next to the image type
+    (first of Constant.HeaderObj.TYPE_KEY found), Bayer pattern and filter from its header.
+    Updating a directory only re-reads the headers of files that are new or changed since the
+    last run and forgets files that are gone, so repeated runs don't touch unchanged frames.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS frames (
+            path TEXT PRIMARY KEY,
+            directory TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            mtime REAL NOT NULL,
+            type TEXT,
+            bayerpat TEXT,
+            filter TEXT
+        )
+    """
+
+    def __init__(self, db_path: str=Constant.INDEX_PATH):
+        """
+        Open (or create) the index database.
+
+        params
+        ------
+        db_path: str, optional
+            Path to the SQLite file holding the index
+        """
+
+        self.db_path = db_path.replace("\\", "/")
+
+        if os.path.dirname(self.db_path):
+            os.makedirs(os.path.dirname(self.db_path), exist_ok=True)
+
+        self.connection = sqlite3.connect(self.db_path)
+        self.connection.execute(self.SCHEMA)
+        self.connection.execute("CREATE INDEX IF NOT EXISTS frames_directory ON frames (directory)")
+        self.connection.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        """
+        Close the database connection.
+        """
+
+        self.connection.close()
+
+    @staticmethod
+    def read_keywords(path: str):
+        """
+        Static method to read the indexed keywords from the primary header of a FITS file.
+
+        params
+        ------
+        path: str
+            Complete path to FITS file
+
+        return
+        ------
+        tuple(str | None, str | None, str | None)
+            Image type, Bayer pattern and filter, None for any keyword that is missing
+        """
+
+        header = Fits.read_header(path)
+
+        img_type = None
+        for key in Constant.HeaderObj.TYPE_KEY:
+            if header.get(key) is not None:
+                img_type = header[key]
+                break
+
+        return img_type, header.get(Constant.HeaderObj.BAYER_KEY), header.get(Constant.HeaderObj.FILTER_KEY)
+
+    def update(self, path: str, workers: int=None):
+        """
+        Bring the index of a directory up to date with what is on disk.
+
+        params
+        ------
+        path: str
+            Path to directory with FITS images
+        workers: int, optional
+            Number of threads reading headers of new or changed files
+
+        return
+        ------
+        int
+            Number of files whose headers had to be (re-)read
+        """
+
+        # change to POSIX format for consistency
+        format_path = path.replace("\\", "/").rstrip("/")
+
+        if not os.path.isdir(format_path):
+            raise NotADirectoryError(f"Provided path {path} is not a directory")
+
+        # what is on disk right now
+        on_disk = {}
+        with os.scandir(format_path) as entries:
+            for entry in entries:
+                file_path = f"{format_path}/{entry.name}"
+                if entry.is_file() and Fits.check_path(file_path):
+                    stat = entry.stat()
+                    on_disk[file_path] = (stat.st_size, stat.st_mtime)
+
+        # what the index remembers
+        indexed = {
+            row[0]: (row[1], row[2])
+            for row in self.connection.execute("SELECT path, size, mtime FROM frames WHERE directory = ?", (format_path,))
+        }
+
+        stale = [file_path for file_path, stat in on_disk.items() if indexed.get(file_path) != stat]
+        removed = [file_path for file_path in indexed if file_path not in on_disk]
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            keywords = list(executor.map(HeaderIndex.read_keywords, stale))
+
+        with self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO frames (path, directory, size, mtime, type, bayerpat, filter) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [(file_path, format_path) + on_disk[file_path] + keys for file_path, keys in zip(stale, keywords)],
+            )
+            self.connection.executemany("DELETE FROM frames WHERE path = ?", [(file_path,) for file_path in removed])
+
+        if stale or removed:
+            print(f"Header index of {format_path} updated: {len(stale)} read, {len(removed)} removed")
+
+        return len(stale)
+
+    def query(self, path: str, type: str="N/A", workers: int=None):
+        """
+        Find FITS files in given directory by image type, updating the index of the directory first.
+
+        params
+        ------
+        path: str
+            Path to directory with FITS images
+        type: str, optional
+            Type of images to collect, default assumes that we are pulling everything in the given directory
+        workers: int, optional
+            Number of threads reading headers of new or changed files
+
+        return
+        ------
+        list
+            List of paths to the matching FITS files, sorted by path
+        """
+
+        self.update(path, workers)
+
+        format_path = path.replace("\\", "/").rstrip("/")
+        rows = self.connection.execute("SELECT path, type FROM frames WHERE directory = ? ORDER BY path", (format_path,)).fetchall()
+
+        if type == "N/A":
+            return [row[0] for row in rows]
+
+        for file_path, img_type in rows:
+            if img_type is None:
+                raise KeyError(f"Unable to find image type of {file_path}. Perhaps a different key is used to store the image type?")
+
+        return [file_path for file_path, img_type in rows if img_type == type]
+
+    def get(self, path: str):
+        """
+        Look up the indexed keywords of a single FITS file, indexing it first if needed.
+
+        params
+        ------
+        path: str
+            Complete path to FITS file
+
+        return
+        ------
+        dict
+            Header keywords of the file (Constant.HeaderObj.BAYER_KEY, Constant.HeaderObj.FILTER_KEY
+            and "TYPE"), missing keywords are None
+        """
+
+        format_path = path.replace("\\", "/")
+        stat = os.stat(format_path)
+
+        row = self.connection.execute("SELECT size, mtime, type, bayerpat, filter FROM frames WHERE path = ?", (format_path,)).fetchone()
+
+        if row is None or (row[0], row[1]) != (stat.st_size, stat.st_mtime):
+            keys = HeaderIndex.read_keywords(format_path)
+
+            with self.connection:
+                self.connection.execute(
+                    "INSERT OR REPLACE INTO frames (path, directory, size, mtime, type, bayerpat, filter) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (format_path, os.path.dirname(format_path), stat.st_size, stat.st_mtime) + keys,
+                )
+        else:
+            keys = row[2:]
+
+        return {
+            "TYPE": keys[0],
+            Constant.HeaderObj.BAYER_KEY: keys[1],
+            Constant.HeaderObj.FILTER_KEY: keys[2],
+        }
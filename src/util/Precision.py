@@ -0,0 +1,106 @@
+from astropy.io import fits
+import numpy as np
+
+class Precision:
+    """
+    Precision policy of a run: the floating point type data is processed in, and the type
+    FITS files are written with.
+
+    Set once at start (see app.py), processing functions fall back to it whenever they are
+    not given an explicit dtype. float32 halves memory and bandwidth of every frame at about
+    7 significant digits, plenty for 16-bit sensor data. Storage types:
+
+    - "float64", "float32": BITPIX -64 / -32
+    - "uint16", "int16": values rounded and clipped to the type, uint16 is written as BITPIX 16
+      with BZERO 32768
+    - "scaled": BITPIX 16 with BSCALE / BZERO spanning the range of the data, for calibrated
+      frames that are fractional or negative
+    - None: data is written in the type it has
+    """
+
+    WORKING_TYPES = {"float64": np.float64, "float32": np.float32}
+    STORAGE_TYPES = ("float64", "float32", "uint16", "int16", "scaled")
+
+    working = np.float64
+    storage = None
+
+    @classmethod
+    def configure(cls, working: str="float64", storage: str=None):
+        """
+        Class method to set the policy of the run.
+
+        params
+        ------
+        working: str, optional
+            Name of the working type, one of WORKING_TYPES
+        storage: str, optional
+            Name of the storage type, one of STORAGE_TYPES, None keeps the type of the data
+        """
+
+        if working not in cls.WORKING_TYPES:
+            raise ValueError(f"Invalid working precision: {working}")
+
+        if storage is not None and storage not in cls.STORAGE_TYPES:
+            raise ValueError(f"Invalid storage type: {storage}")
+
+        cls.working = cls.WORKING_TYPES[working]
+        cls.storage = storage
+
+    @classmethod
+    def dtype(cls, dtype: type=None):
+        """
+        Class method resolving an optional dtype argument, the working type when it is not given.
+        """
+
+        return cls.working if dtype is None else dtype
+
+    @staticmethod
+    def storage_hdu(data: np.ndarray, header: fits.Header=None, storage: str=None, hdu_type: type=fits.PrimaryHDU, **kwargs):
+        """
+        Static method building the HDU that stores data with given storage type.
+
+        params
+        ------
+        data: np.ndarray
+            Image data
+        header: fits.Header, optional
+            Header to carry over, its scaling keywords are replaced by those of the storage type
+        storage: str, optional
+            Name of the storage type, one of STORAGE_TYPES, None keeps the type of the data
+        hdu_type: type, optional
+            fits.PrimaryHDU, fits.ImageHDU or fits.CompImageHDU, default to fits.PrimaryHDU
+        **kwargs
+            Passed on to hdu_type, e.g. name or compression_type
+
+        return
+        ------
+        fits.PrimaryHDU | fits.ImageHDU | fits.CompImageHDU
+            HDU ready to be written, BITPIX, BSCALE and BZERO set by astropy
+        """
+
+        header = header.copy() if header is not None else None
+
+        if header is not None:
+            for key in ("BSCALE", "BZERO"):
+                header.remove(key, ignore_missing=True)
+
+        data = np.asarray(data)
+
+        if storage is None:
+            return hdu_type(data=data, header=header, **kwargs)
+
+        if storage in ("float64", "float32"):
+            return hdu_type(data=data.astype(storage, copy=False), header=header, **kwargs)
+
+        if storage in ("uint16", "int16"):
+            info = np.iinfo(storage)
+            values = np.rint(data) if data.dtype.kind == "f" else data
+
+            return hdu_type(data=np.clip(values, info.min, info.max).astype(storage), header=header, **kwargs)
+
+        if storage == "scaled":
+            hdu = hdu_type(data=data.astype(np.float64), header=header, **kwargs)
+            hdu.scale("int16", "minmax")
+            return hdu
+
+        raise ValueError(f"Invalid storage type: {storage}")
@@ -0,0 +1,197 @@
+import hashlib
+import json
+import numpy as np
+import os
+import shutil
+
+from src.util import outputimg
+from src.util.Fits import *
+from src.util.Constant import *
+
+class PreviewPyramid:
+    """
+    Tiled multi-resolution previews of frames, cached on disk.
+
+    Level 0 is the frame at full resolution, every next level bins 2x2 blocks of the previous one
+    into their mean, down to the first level that fits in a single tile. Every level is cut into
+    tile_size x tile_size images (edge tiles are smaller), so a viewer only fetches the tiles it
+    shows at the resolution it shows them. All levels are rendered with the display range of the
+    full resolution frame, so they look alike.
+
+    Each frame gets a directory named after it:
+
+        <preview_dir>/<name>/manifest.json
+        <preview_dir>/<name>/<level>/<row>_<column>.png
+
+    The manifest records a key of the source data and rendering settings, a frame is only
+    rendered again when its key changes. It is written last, so an interrupted build is redone.
+    """
+
+    MANIFEST = "manifest.json"
+
+    def __init__(self, preview_dir: str=Constant.PREVIEW_PATH, tile_size: int=256, stretch: str="linear", boost_factor: float=1, percentiles: tuple=None, extension: str=".png", level: int=None):
+        """
+        params
+        ------
+        preview_dir: str, optional
+            Directory the pyramids are stored in
+        tile_size: int, optional
+            Width and height of the tiles in pixels, default to 256
+        stretch: str, optional
+            One of outputimg.STRETCHES, default to "linear"
+        boost_factor: float, optional
+            Float value to multiply the normalized pixels in hopes of bringing out contrast
+        percentiles: tuple(float, float), optional
+            Percentiles clipped to black and white, default to the full range of each channel
+        extension: str, optional
+            Image format of the tiles, one of outputimg.ENCODERS, default to ".png"
+        level: int, optional
+            PNG compression level or JPEG / WebP quality of the tiles, see outputimg.write_image
+        """
+
+        self.preview_dir = preview_dir.replace("\\", "/").rstrip("/")
+        self.tile_size = tile_size
+        self.stretch = stretch
+        self.boost_factor = boost_factor
+        self.percentiles = percentiles
+        self.extension = extension
+        self.level = level
+
+        os.makedirs(self.preview_dir, exist_ok=True)
+
+    @staticmethod
+    def source_key(channels: list[Fits]):
+        """
+        Static method identifying the data of the source Fits objects, see Fits.fingerprint.
+
+        return
+        ------
+        str
+            Hex digest of the sources
+        """
+
+        return hashlib.sha256("\n".join(fits_img.fingerprint() for fits_img in channels).encode()).hexdigest()
+
+    def key(self, channels: list[Fits]):
+        """
+        Key of a pyramid, depending on the source data and on how it is rendered.
+        """
+
+        settings = f"{self.tile_size}\0{self.stretch}\0{self.boost_factor}\0{self.percentiles}\0{self.extension}\0{self.level}"
+        return hashlib.sha256(f"{PreviewPyramid.source_key(channels)}\0{settings}".encode()).hexdigest()
+
+    def frame_dir(self, name: str):
+        """
+        Directory of the pyramid of a frame.
+        """
+
+        return f"{self.preview_dir}/{name}"
+
+    def tile_path(self, name: str, level: int, row: int, column: int):
+        """
+        Path of one tile, level 0 being full resolution.
+        """
+
+        return f"{self.frame_dir(name)}/{level}/{row}_{column}{self.extension}"
+
+    def load(self, name: str):
+        """
+        Manifest of the pyramid of a frame, None when there is none.
+        """
+
+        manifest_path = f"{self.frame_dir(name)}/{self.MANIFEST}"
+
+        if not os.path.isfile(manifest_path):
+            return None
+
+        with open(manifest_path) as file:
+            return json.load(file)
+
+    @staticmethod
+    def downsample(data: np.ndarray):
+        """
+        Static method binning 2x2 blocks into their mean, odd sizes are padded by repeating the last row or column.
+
+        return
+        ------
+        np.ndarray
+            float32 array of half the size, rounded up
+        """
+
+        data = np.asarray(data, dtype=np.float32)
+        height, width = data.shape
+
+        if height % 2 or width % 2:
+            data = np.pad(data, ((0, height % 2), (0, width % 2)), mode="edge")
+
+        return (data[0::2, 0::2] + data[1::2, 0::2] + data[0::2, 1::2] + data[1::2, 1::2]) * 0.25
+
+    def build(self, channels: list[Fits], name: str=None):
+        """
+        Render the pyramid of a frame, unless it is cached for the same data and settings.
+
+        params
+        ------
+        channels: list[Fits]
+            Red, green and blue channels, a multi-channel Fits object (Fits.channelcreate) alone,
+            or a single channel for grayscale tiles
+        name: str, optional
+            Name of the pyramid directory, default to the file name of the first channel
+
+        return
+        ------
+        dict
+            Manifest of the pyramid: key, tile_size, extension and, for every level, its shape
+            and number of tile rows and columns
+        """
+
+        if name is None:
+            fp = channels[0].path
+            name = fp[fp.rfind("/") + 1:].removesuffix(".fits")
+
+        key = self.key(channels)
+        manifest = self.load(name)
+
+        if manifest is not None and manifest["key"] == key:
+            print(f"Preview of {name} is up to date in {self.frame_dir(name)}")
+            return manifest
+
+        # drop the old pyramid, its levels and tiles may not match the new one
+        directory = self.frame_dir(name)
+        if os.path.isdir(directory):
+            shutil.rmtree(directory)
+
+        datas = outputimg.channel_arrays(channels)
+        value_ranges = [outputimg.display_range(data, self.percentiles) for data in datas]
+
+        levels = []
+        while True:
+            level = len(levels)
+            height, width = datas[0].shape
+            rows, columns = -(-height // self.tile_size), -(-width // self.tile_size)
+
+            image = outputimg.render_image(datas, self.stretch, self.boost_factor, value_ranges=value_ranges)
+
+            os.makedirs(f"{directory}/{level}")
+            for row in range(rows):
+                for column in range(columns):
+                    tile = image[row * self.tile_size:(row + 1) * self.tile_size, column * self.tile_size:(column + 1) * self.tile_size]
+                    outputimg.write_image(self.tile_path(name, level, row, column), tile, self.level)
+
+            levels.append({"shape": [height, width], "rows": rows, "columns": columns})
+
+            if rows == 1 and columns == 1:
+                break
+
+            # every level is binned from the previous one, not from the full resolution frame
+            datas = [PreviewPyramid.downsample(data) for data in datas]
+
+        manifest = {"key": key, "tile_size": self.tile_size, "extension": self.extension, "levels": levels}
+
+        manifest_path = f"{directory}/{self.MANIFEST}"
+        with open(manifest_path + ".tmp", "w") as file:
+            json.dump(manifest, file)
+        os.replace(manifest_path + ".tmp", manifest_path)
+
+        print(f"Preview of {name} generated in {directory}, {len(levels)} levels")
+        return manifest
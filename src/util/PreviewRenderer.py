@@ -0,0 +1,116 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from src.util import outputimg
+from src.util.Fits import *
+
+class PreviewRenderer:
+    """
+    Renders and encodes frame previews on a pool of threads.
+
+    The heavy parts of a preview (cv2 scaling, table lookups and image encoding) release the GIL,
+    so threads render several frames at once without copying them to other processes. submit()
+    returns right away while fewer than max_pending previews are waiting, and blocks otherwise,
+    which keeps the memory held by frames waiting for their preview bounded. close() waits for
+    every preview and raises the first failure.
+
+    Submitted Fits objects are rendered as they are when a thread gets to them, so they must not
+    be modified after being submitted. Writing them meanwhile, e.g. with a FitsWriter, is safe:
+    diskwrite() never byteswaps the arrays in place. Previews are not reported one by one from the
+    threads, close() returns their paths.
+    """
+
+    def __init__(self, workers: int=None, max_pending: int=None, extension: str=".png", level: int=None, boost_factor: float=1, stretch: str="linear", percentiles: tuple=None):
+        """
+        Start the rendering threads.
+
+        params
+        ------
+        workers: int, optional
+            Number of rendering threads, default to the number of CPUs
+        max_pending: int, optional
+            Number of previews that may be waiting or in progress before submit() blocks, default to twice workers
+        extension: str, optional
+            Image format, one of outputimg.ENCODERS, default to ".png"
+        level: int, optional
+            PNG compression level (0 to 9) or JPEG / WebP quality (1 to 100), see outputimg.write_image
+        boost_factor, stretch, percentiles
+            See outputimg.render_channel
+        """
+
+        workers = workers or os.cpu_count() or 1
+
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="PreviewRenderer")
+        self.slots = threading.BoundedSemaphore(max_pending or 2 * workers)
+        self.futures = []
+        self.options = {"extension": extension, "level": level, "boost_factor": boost_factor, "stretch": stretch, "percentiles": percentiles}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # don't hide the exception that ended the with block behind a rendering error
+        if exc_type is None:
+            self.close()
+        else:
+            self.executor.shutdown(wait=True, cancel_futures=True)
+
+    def submit(self, file_name: str, channels: list[Fits]):
+        """
+        Queue the preview of a frame, blocking while too many are pending.
+
+        params
+        ------
+        file_name: str
+            File name of the preview without extension, it is written in the output folder
+        channels: list[Fits]
+            Red, green and blue channels, a multi-channel Fits object alone, or a single channel for grayscale
+        """
+
+        self.slots.acquire()
+
+        future = self.executor.submit(outputimg.generate_preview, file_name, channels, **self.options)
+        future.add_done_callback(lambda _: self.slots.release())
+        self.futures.append(future)
+
+    def close(self):
+        """
+        Wait for every submitted preview and stop the threads, can be called more than once.
+
+        return
+        ------
+        list[str]
+            Paths of the previews, in the order they were submitted
+        """
+
+        self.executor.shutdown(wait=True)
+
+        # result() raises the exception of a failed preview
+        return [future.result() for future in self.futures]
+
+    @staticmethod
+    def batch(frames: list[tuple], workers: int=None, **options):
+        """
+        Static method rendering the previews of a list of frames on a pool of threads.
+
+        params
+        ------
+        frames: list[tuple(str, list[Fits])]
+            File name of each preview and the channels it is rendered from, see submit
+        workers: int, optional
+            Number of rendering threads, default to the number of CPUs
+        **options
+            extension, level, boost_factor, stretch and percentiles, see __init__
+
+        return
+        ------
+        list[str]
+            Paths of the previews, in the order of frames
+        """
+
+        with PreviewRenderer(workers, **options) as renderer:
+            for file_name, channels in frames:
+                renderer.submit(file_name, channels)
+
+            return renderer.close()
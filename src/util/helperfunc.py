@@ -1,7 +1,9 @@
+import multiprocessing
 import numpy as np
 import cv2
 
 from src.util.Fits import *
+from src.util import stats
 from src.module import flatprocessing
 
 def resize_fits_data(fits_img: Fits, target_shape: tuple):
@@ -11,50 +13,164 @@ def resize_fits_data(fits_img: Fits, target_shape: tuple):
     fits_img.set_data(resized_data)
     return fits_img
 
+def process_context():
+    """
+    Multiprocessing context worker pools are started with.
+
+    Workers are started from a clean server process (forkserver) rather than forked, a fork while
+    other threads (e.g. a FitsWriter) hold a lock leaves the worker waiting on it forever. Where
+    there is no forkserver (Windows) they are spawned.
+
+    return
+    ------
+    multiprocessing.context.BaseContext
+        Context to pass as mp_context to a ProcessPoolExecutor
+    """
+
+    method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+    return multiprocessing.get_context(method)
+
 def adjust_gamma(image: list[list[float]], gamma: float=1.0):
     """Adjusts gamma for an image to control brightness."""
     inv_gamma = 1.0 / gamma
-    image = image / np.max(image)  # Normalize before gamma correction
-    return np.power(image, inv_gamma) * np.max(image)
+    max_val = stats.minmax(image)[1]   # single pass
+    image = image / max_val  # Normalize before gamma correction
+    return np.power(image, inv_gamma) * max_val
 
 def histogram_equalize(image: list[list[float]]):
     """Applies histogram equalization to enhance contrast."""
-    normalized_image = (image / np.max(image) * 255).astype(np.uint8)
+    max_val = stats.minmax(image)[1]
+    normalized_image = (image / max_val * 255).astype(np.uint8)
     equalized_image = cv2.equalizeHist(normalized_image)
-    return equalized_image / 255.0 * np.max(image)  # Rescale to original max range
+    return equalized_image / 255.0 * max_val  # Rescale to original max range
 
-def color_equalize(red: Fits, green: Fits, blue: Fits):
-    r = red.get_data()
-    g = green.get_data()
-    b = blue.get_data()
-    
-    r_mean = np.mean(r)
-    g_mean = np.mean(g)
-    b_mean = np.mean(b)
+def channel_statistics(channels, step: int=1):
+    """
+    Mean and standard deviation of every color channel, each channel read in a single pass.
 
-    r_std = np.std(r)
-    g_std = np.std(g)
-    b_std = np.std(b)
-    
-    green_a = 1
-    green_b = 0
-    
-    blue_a = g_std / b_std
-    blue_b = g_mean - blue_a * b_mean
-    
-    red_a = g_std / r_std
-    red_b = g_mean - red_a * r_mean
-    
-    red.set_data(np.multiply(r,red_a))
-    red.set_data(np.add(r,red_b))
-    
-    green.set_data(np.multiply(g,green_a))
-    green.set_data(np.add(g,green_b))
-    
-    blue.set_data(np.multiply(b,blue_a))
-    blue.set_data(np.add(b,blue_b))
+    params
+    ------
+    channels: np.ndarray | list[np.ndarray]
+        Stacked rows x columns x channels array, or one 2D array per channel
+    step: int, optional
+        Only every step-th row and column is read, e.g. 4 estimates the statistics from 1/16 of
+        the pixels. Default to 1 (every pixel)
+
+    return
+    ------
+    tuple(np.ndarray, np.ndarray)
+        Means and standard deviations, one per channel
+    """
+
+    planes = [channels] if isinstance(channels, np.ndarray) and channels.ndim == 3 else channels
+    means, stds = [], []
+
+    for plane in planes:
+        # cv2 reads native byte order only, the copy is small when subsampling
+        sample = np.ascontiguousarray(plane[::step, ::step], dtype=plane.dtype.newbyteorder("="))
+        mean, std = cv2.meanStdDev(sample)
+
+        if not (np.all(np.isfinite(mean)) and np.all(np.isfinite(std))):
+            # NaN pixels, rare enough to take the slow path
+            sample = sample.reshape(-1, mean.size).astype(np.float64)
+            mean, std = np.nanmean(sample, axis=0), np.nanstd(sample, axis=0)
+
+        means.extend(np.ravel(mean))
+        stds.extend(np.ravel(std))
+
+    return np.array(means), np.array(stds)
+
+def color_equalize_data(red: np.ndarray, green: np.ndarray=None, blue: np.ndarray=None, step: int=1):
+    """
+    Balance color channels in place, red and blue get the mean and standard deviation of green.
+
+    Statistics are read in one pass per channel (see channel_statistics), the affine correction
+    is applied in another, without temporaries.
+
+    params
+    ------
+    red: np.ndarray
+        Red channel, or a stacked rows x columns x 3 array in RGB order when green and blue are not given
+    green: np.ndarray, optional
+        Green channel
+    blue: np.ndarray, optional
+        Blue channel
+    step: int, optional
+        Estimate the statistics from every step-th row and column only, see channel_statistics
+
+    return
+    ------
+    tuple(np.ndarray, np.ndarray, np.ndarray) | np.ndarray
+        The balanced channels, or the balanced stacked array
+    """
+
+    stacked = green is None and blue is None
+    channels = red if stacked else [red, green, blue]
+
+    means, stds = channel_statistics(channels, step)
+    gains = np.divide(stds[1], stds, out=np.ones(3), where=stds > 0)
+    offsets = means[1] - gains * means
+
+    for data in [red] if stacked else channels:
+        if data.dtype.kind != "f" or not data.flags.writeable:
+            raise ValueError("Channels must be writable floating point arrays to be balanced in place")
+
+    if stacked:
+        if red.flags.c_contiguous and red.dtype.isnative:
+            cv2.multiply(red, (*gains, 0), dst=red)
+            cv2.add(red, (*offsets, 0), dst=red)
+        else:
+            red *= gains
+            red += offsets
+        return red
+
+    for data, gain, offset in zip(channels, gains, offsets):
+        if gain == 1 and offset == 0:
+            continue    # green, or a channel already balanced
+        if data.flags.c_contiguous and data.dtype.isnative:
+            cv2.addWeighted(data, gain, data, 0, offset, dst=data)
+        else:
+            np.multiply(data, gain, out=data)
+            np.add(data, offset, out=data)
+
+    return red, green, blue
+
+def color_equalize(red: Fits, green: Fits, blue: Fits, step: int=1):
+    """
+    Balance the color channels of Fits objects, see color_equalize_data.
+
+    Channels still backed by their file, or not in floating point, are balanced in a copy in the
+    working type (Precision.working) that replaces their data, the others in place.
+
+    params
+    ------
+    red: Fits
+        Red channel
+    green: Fits
+        Green channel
+    blue: Fits
+        Blue channel
+    step: int, optional
+        Estimate the statistics from every step-th row and column only
+    """
+
+    datas = []
+    copied = []
+    for channel in (red, green, blue):
+        data = channel.get_data()
+
+        if channel.is_file_backed or data.dtype.kind != "f" or not data.flags.writeable:
+            data = np.array(data, dtype=Precision.working)
+            copied.append((channel, data))
+        datas.append(data)
+
+    color_equalize_data(*datas, step=step)
+
+    # data balanced in place already is the data of its HDU
+    for channel, data in copied:
+        channel.set_data(data)
 
-def extract_rgb_from_fits(fits_img: Fits, directory: str):
+def extract_rgb_from_fits(fits_img: Fits, directory: str, superpixel: bool=False, dtype: type=None):
     """
     Extract RGB channels from a FITS file based on the Bayer pattern and save each as a separate FITS file.
 
@@ -64,6 +180,11 @@ def extract_rgb_from_fits(fits_img: Fits, directory: str):
         Fits image object with valid Bayer pattern listed on the header file
     directory: str
         Directory path as string for Fits object
+    superpixel: bool, optional
+        Collapse each 2x2 Bayer cell into one pixel instead of interpolating full-size channels,
+        the channels are then half the width and height of the image
+    dtype: type, optional
+        Floating point type of the channels, default to Precision.working
 
     return
     ------
@@ -71,10 +192,13 @@ def extract_rgb_from_fits(fits_img: Fits, directory: str):
         Tuple of three Fits objects each representing a color channel (Red, Green, Blue)
     """
     
-    data = fits_img.get_data().astype(float)
+    data = fits_img.get_data()
     bayer_pat = fits_img.bayerpat()
 
-    red_image, green_image, blue_image = flatprocessing.extract_rgb_optimized(data, bayer_pat)
+    if superpixel:
+        red_image, green_image, blue_image = flatprocessing.demosaic_superpixel(data, bayer_pat, dtype)
+    else:
+        red_image, green_image, blue_image = flatprocessing.demosaic_bilinear(data, bayer_pat, dtype)
         
     # Save each channel as a FITS file
     fn = directory + fits_img.path[fits_img.path.rfind("/") + 1:len(fits_img.path) - 5] # just the filename, without .fits extension
@@ -84,4 +208,3 @@ def extract_rgb_from_fits(fits_img: Fits, directory: str):
     blue_fits = Fits.filecreate(fn + "_b.fits", blue_image)
     
     return red_fits, green_fits, blue_fits
-    
\ No newline at end of file
@@ -1,13 +1,245 @@
 from PIL import Image
 import cv2 # switching from Pillow to cv2
 import numpy as np
+import functools
 
+from src.util import stats
 from src.util.Fits import *
 from src.util.Constant import *
 
+# stretches applied to the normalized [0, 1] values of a channel, with the parameter used when none is given
+STRETCHES = {
+    "linear": None,
+    "asinh": 10.0,      # softening, higher lifts faint values more
+    "log": 1000.0,      # scale inside the log
+    "gamma": 2.2,       # values are raised to 1 / gamma
+}
+
+# cv2 setting of each image format: compression level for PNG (0 to 9), quality for JPEG and WebP (1 to 100)
+ENCODERS = {
+    ".png": cv2.IMWRITE_PNG_COMPRESSION,
+    ".jpg": cv2.IMWRITE_JPEG_QUALITY,
+    ".jpeg": cv2.IMWRITE_JPEG_QUALITY,
+    ".webp": cv2.IMWRITE_WEBP_QUALITY,
+}
+
+def native_data(data: np.ndarray):
+    """
+    Data in native byte order, as cv2 reads the raw buffer. FITS files are big-endian.
+    """
+
+    data = np.asarray(data)
+
+    if data.dtype == bool:
+        return data.view(np.uint8)
+    if not data.dtype.isnative:
+        return data.astype(data.dtype.newbyteorder("="))
+    return data
+
+def display_range(data: np.ndarray, percentiles: tuple=None, sample_size: int=stats.DEFAULT_SAMPLE_SIZE):
+    """
+    Range of data values mapped from black to white, percentiles are remembered per array (see stats.cached).
+
+    params
+    ------
+    data: np.ndarray
+        Image data
+    percentiles: tuple(float, float), optional
+        Lower and upper percentile (0 to 100) clipped to black and white, e.g. (0.5, 99.5).
+        Default to the full range of the data
+    sample_size: int, optional
+        Approximate number of values the percentiles are estimated from, see stats.sample
+
+    return
+    ------
+    tuple(float, float)
+        Value shown as black and value shown as white
+    """
+
+    if percentiles is None:
+        return stats.minmax(data)
+
+    return stats.percentile(data, tuple(percentiles), sample_size)
+
+@functools.lru_cache(maxsize=32)
+def stretch_lut(stretch: str, boost_factor: float=1.0, parameter: float=None):
+    """
+    Lookup table of a stretch from 16-bit quantized values to 8-bit pixels, built once per setting.
+
+    params
+    ------
+    stretch: str
+        One of STRETCHES
+    boost_factor: float, optional
+        Multiplies the normalized values before the stretch
+    parameter: float, optional
+        Parameter of the stretch, default from STRETCHES
+
+    return
+    ------
+    np.ndarray
+        65536 uint8 pixel values, read only
+    """
+
+    if stretch not in STRETCHES:
+        raise ValueError(f"Invalid stretch: {stretch}")
+
+    if parameter is None:
+        parameter = STRETCHES[stretch]
+
+    x = np.minimum(np.arange(65536) / 65535 * boost_factor, 1.0)
+
+    if stretch == "asinh":
+        x = np.arcsinh(parameter * x) / np.arcsinh(parameter)
+    elif stretch == "log":
+        x = np.log1p(parameter * x) / np.log1p(parameter)
+    elif stretch == "gamma":
+        x = np.power(x, 1 / parameter)
+
+    lut = np.rint(np.clip(x, 0, 1) * 255).astype(np.uint8)
+    lut.flags.writeable = False
+    return lut
+
+def render_channel(data: np.ndarray, stretch: str="linear", boost_factor: float=1, percentiles: tuple=None, parameter: float=None, value_range: tuple=None):
+    """
+    Render one channel as 8-bit pixels.
+
+    The data is scaled from its display range and saturated to the output type in one pass,
+    straight to 8 bits for a linear stretch, to 16 bits followed by a table lookup otherwise,
+    so no floating point temporaries are made. NaN is shown as black.
+
+    params
+    ------
+    data: np.ndarray
+        Image data of the channel
+    stretch: str, optional
+        One of STRETCHES, default to "linear"
+    boost_factor: float, optional
+        Float value to multiply the normalized pixels in hopes of bringing out contrast
+    percentiles: tuple(float, float), optional
+        Percentiles clipped to black and white, see display_range. Default to the full range
+    parameter: float, optional
+        Parameter of the stretch, see STRETCHES
+    value_range: tuple(float, float), optional
+        Values shown as black and white, overrides percentiles. Used to render parts of an image
+        (tiles, downsampled levels) with the range of the whole
+
+    return
+    ------
+    np.ndarray
+        2D uint8 array
+    """
+
+    # range of the data as given, so it is found in the cache (see stats.cached) even for big-endian data
+    min_val, max_val = value_range if value_range is not None else display_range(data, percentiles)
+    data = native_data(data)
+
+    if not max_val > min_val:
+        return np.zeros(data.shape, dtype=np.uint8)
+
+    if stretch == "linear":
+        scale = 255 * boost_factor / (max_val - min_val)
+        return cv2.addWeighted(data, scale, data, 0, -min_val * scale, dtype=cv2.CV_8U)
+
+    lut = stretch_lut(stretch, float(boost_factor), parameter)
+    scale = 65535 / (max_val - min_val)
+    quantized = cv2.addWeighted(data, scale, data, 0, -min_val * scale, dtype=cv2.CV_16U)
+
+    return np.take(lut, quantized)
+
+def render_image(channels: list, stretch: str="linear", boost_factor: float=1, percentiles: tuple=None, parameter: float=None, value_ranges: list=None):
+    """
+    Render channels as an image cv2 can write, each channel stretched on its own range.
+
+    params
+    ------
+    channels: list[np.ndarray]
+        Red, green and blue channel data, or a single channel for a grayscale image
+    stretch, boost_factor, percentiles, parameter
+        See render_channel
+    value_ranges: list[tuple(float, float)], optional
+        Value range of every channel, see render_channel
+
+    return
+    ------
+    np.ndarray
+        uint8 array, rows x columns for one channel, rows x columns x 3 in BGR order for three
+    """
+
+    if value_ranges is None:
+        value_ranges = [None] * len(channels)
+
+    rendered = [render_channel(data, stretch, boost_factor, percentiles, parameter, value_range) for data, value_range in zip(channels, value_ranges)]
+
+    if len(rendered) == 1:
+        return rendered[0]
+
+    return cv2.merge(rendered[::-1])    # cv2 follows the order BGR
+
+def channel_arrays(channels: list[Fits]):
+    """
+    Data of every channel of given Fits objects, multi-channel ones (Fits.channelcreate) included.
+    """
+
+    return [data for fits_img in channels for data in fits_img.channel_data()]
+
+def write_image(path: str, image: np.ndarray, level: int=None):
+    """
+    Encode and write a rendered image, the format is taken from the file extension.
+
+    params
+    ------
+    path: str
+        Path of the image file, ending in one of ENCODERS
+    image: np.ndarray
+        uint8 image from render_image
+    level: int, optional
+        PNG compression level (0 to 9) or JPEG / WebP quality (1 to 100), default to the cv2 default
+    """
+
+    extension = path[path.rfind("."):].lower()
+
+    if extension not in ENCODERS:
+        raise ValueError(f"Invalid image format: {extension}")
+
+    params = [ENCODERS[extension], int(level)] if level is not None else []
+
+    if not cv2.imwrite(path, image, params):
+        raise OSError(f"Could not write image {path}")
+
+def generate_preview(file_name: str, channels: list[Fits], extension: str=".png", level: int=None, boost_factor: float=1, stretch: str="linear", percentiles: tuple=None):
+    """
+    Render and write the preview of a frame in the output folder.
+
+    params
+    ------
+    file_name: str
+        File name of the preview without extension
+    channels: list[Fits]
+        Red, green and blue channels, a multi-channel Fits object alone, or a single channel for grayscale
+    extension: str, optional
+        Image format, one of ENCODERS, default to ".png"
+    level: int, optional
+        PNG compression level or JPEG / WebP quality, see write_image
+    boost_factor, stretch, percentiles
+        See render_channel
+
+    return
+    ------
+    str
+        Path of the preview
+    """
+
+    image = render_image(channel_arrays(channels), stretch, boost_factor, percentiles)
+
+    path = Constant.OUTPUT_PATH + file_name + extension
+    write_image(path, image, level)
+
+    return path
+
 # TODO: This implementation is not accurate. It is better to be given the 
 #       separate channels as arguments to ensure that the datas are correct
-def generate_img(fits_img: Fits, boost_factor: float = 1.0):
+def generate_img(fits_img: Fits, boost_factor: float = 1.0, stretch: str = "linear", percentiles: tuple = None):
     """
     Generate a PNG file from given Fits object and boosting the pixels
 
@@ -17,6 +249,10 @@ def generate_img(fits_img: Fits, boost_factor: float = 1.0):
         Fits object to be converted into PNG image
     boost_factor: float, optional
         Float value to boost the image's contrast
+    stretch: str, optional
+        One of STRETCHES, default to "linear"
+    percentiles: tuple(float, float), optional
+        Percentiles clipped to black and white, default to the full range
     """
     
     # path to save the image
@@ -24,27 +260,15 @@ def generate_img(fits_img: Fits, boost_factor: float = 1.0):
     filename = fits_img.path[slash_idx + 1:-5]  # this grabs only the filename from the complete path 
     path = Constant.OUTPUT_PATH + filename + ".png"
 
-    # get data from FITS image
-    fits_data = np.array(fits_img.get_data())
-
-    max_val = np.max(fits_data)
-    min_val = np.min(fits_data)
-
-    # scaling data to 8 bits and perform linear contrast stretching
-    scaled_data = (fits_data - min_val) / (max_val - min_val) * 255 * boost_factor
-
-    # clip to valid range after boosting
-    scaled_data = np.clip(scaled_data, 0, 255)
-
-    # cast to 8-bit unsigned integer
-    scaled_data = scaled_data.astype(np.uint8)
+    # scaling data to 8 bits and perform contrast stretching
+    scaled_data = render_channel(fits_img.get_data(), stretch, boost_factor, percentiles)
 
     image = Image.fromarray(scaled_data)
     image.save(path)
 
     print(f"Image saved as {path}")
 
-def generate_PNG(file_name: str, red_channel: Fits, green_channel: Fits, blue_channel: Fits, boost_factor: float = 1):
+def generate_PNG(file_name: str, red_channel: Fits, green_channel: Fits = None, blue_channel: Fits = None, boost_factor: float = 1, stretch: str = "linear", percentiles: tuple = None):
     """
     Generate a full image from given color channel values in the output folder as .png file.
 
@@ -53,42 +277,37 @@ def generate_PNG(file_name: str, red_channel: Fits, green_channel: Fits, blue_ch
     filename: str
         The complete file name (with .png) that the output will be written with
     red_channel: Fits
-        Red channel values as a Fits object
-    green_channel: Fits
+        Red channel values as a Fits object, or a multi-channel Fits object (Fits.channelcreate)
+        holding all three channels when green_channel and blue_channel are not given
+    green_channel: Fits, optional
         Green channel values as a Fits object
-    blue_channel: Fits
+    blue_channel: Fits, optional
         Blue channel values as a Fits object
     boost_factor: float, optional
         Float value to multiply the pixels in hopes of bringing out contrast
+    stretch: str, optional
+        One of STRETCHES, default to "linear"
+    percentiles: tuple(float, float), optional
+        Percentiles clipped to black and white, e.g. (0.5, 99.5), default to the full range
     """
 
-    # helper function
-    def scale_channel(data, min_val, max_val):
-        scaled_data = (data - min_val) / (max_val - min_val) * 255 * boost_factor   # doing the math
-        scaled_data = np.clip(scaled_data, 0, 255)  # clips any value outside the range
+    # one file holding every channel
+    if green_channel is None and blue_channel is None:
+        channels = red_channel.channel_data()
+    else:
+        channels = [red_channel.get_data(), green_channel.get_data(), blue_channel.get_data()]
 
-        return scaled_data.astype(np.uint8)
-    
     # scaling the channels to 256 bits
-    red_data = np.array(red_channel.get_data())
-    red_scaled = scale_channel(red_data, np.min(red_data), np.max(red_data))
-
-    green_data = np.array(green_channel.get_data())
-    green_scaled = scale_channel(green_data, np.min(green_data), np.max(green_data),)
-    
-    blue_data = np.array(blue_channel.get_data())
-    blue_scaled = scale_channel(blue_data, np.min(blue_data), np.max(blue_data))
-
-    rgb_image = cv2.merge((blue_scaled, green_scaled, red_scaled))  # cv2 follows the order BGR, or so I'm told
+    rgb_image = render_image(channels, stretch, boost_factor, percentiles)
 
     path = Constant.OUTPUT_PATH + file_name
     cv2.imwrite(path, rgb_image)
     print(f"PNG image generated at {path}")
 
 # Wrapper for grayscale images
-def generate_grayscale_PNG(file_name: str, image_data: Fits, boost_factor: float = 1):
+def generate_grayscale_PNG(file_name: str, image_data: Fits, boost_factor: float = 1, stretch: str = "linear", percentiles: tuple = None):
     """
-    Generate a full image in gray scale.
+    Generate a full image in gray scale, written as a single-channel PNG.
 
     params
     ------
@@ -98,5 +317,14 @@ def generate_grayscale_PNG(file_name: str, image_data: Fits, boost_factor: float
         Fits object with pixel values to be used for image generation
     boost_factor: float, optional
         Float value to multiply the pixels in hopes of bringing out contrast
+    stretch: str, optional
+        One of STRETCHES, default to "linear"
+    percentiles: tuple(float, float), optional
+        Percentiles clipped to black and white, default to the full range
     """
-    generate_PNG(file_name, image_data, image_data, image_data, boost_factor)
+
+    gray_image = render_channel(image_data.get_data(), stretch, boost_factor, percentiles)
+
+    path = Constant.OUTPUT_PATH + file_name
+    cv2.imwrite(path, gray_image)
+    print(f"PNG image generated at {path}")
@@ -0,0 +1,199 @@
+import cv2
+import hashlib
+import numpy as np
+import threading
+import weakref
+
+# number of values estimates are computed from by default
+DEFAULT_SAMPLE_SIZE = 250_000
+
+# id of an array -> {statistic key: (digest of the values it was computed from, value)}
+_cache = {}
+_lock = threading.Lock()
+
+def sample(data: np.ndarray, sample_size: int=DEFAULT_SAMPLE_SIZE, random: bool=False):
+    """
+    Values of data to estimate statistics from.
+
+    params
+    ------
+    data: np.ndarray
+        Image data
+    sample_size: int, optional
+        Approximate number of values to take, None for all of them. Estimates get more precise
+        with more values, the error of a median or percentile shrinks with the square root of it
+    random: bool, optional
+        Take values at random positions (seeded, so the same data gives the same sample) instead
+        of on a regular grid over the image. The grid is faster, random positions can't line up
+        with periodic patterns in the data
+
+    return
+    ------
+    np.ndarray
+        1D array of the values
+    """
+
+    data = np.asarray(data)
+
+    if sample_size is None or data.size <= sample_size:
+        return data.ravel()
+
+    if random:
+        index = np.random.default_rng(0).integers(0, data.size, sample_size)
+        return data[np.unravel_index(index, data.shape)]
+
+    # odd steps, so the grid alternates between even and odd rows and columns and samples
+    # every site of a Bayer mosaic
+    if data.ndim == 2:
+        step = int(np.ceil(np.sqrt(data.size / sample_size))) | 1
+        return data[::step, ::step].ravel()
+
+    return data.reshape(-1)[::int(np.ceil(data.size / sample_size)) | 1]
+
+def cached(data: np.ndarray, key: tuple, values: np.ndarray, compute):
+    """
+    Statistic of values sampled from an array, from the cache or computed and stored when it is not there.
+
+    Statistics are remembered per array object for as long as it lives, next to a digest of the
+    values they were computed from. A cached statistic is only returned when the values sampled
+    now have the same digest, so it is exactly what compute would return: changing the array,
+    in place or not, can't give stale results. Hashing the sample costs less than sorting it.
+
+    params
+    ------
+    data: np.ndarray
+        Array the values were sampled from
+    key: tuple
+        Name and parameters of the statistic
+    values: np.ndarray
+        Values the statistic is computed from, from sample
+    compute: Callable[[np.ndarray], Any]
+        Computes the statistic of values when it is not cached
+
+    return
+    ------
+    Any
+        Result of compute, now or from an earlier call
+    """
+
+    if not isinstance(data, np.ndarray):
+        return compute(values)
+
+    values = np.ascontiguousarray(values)
+    digest = hashlib.sha1(values.view(np.uint8), usedforsecurity=False)
+    digest.update(f"{values.dtype.str}{values.shape}".encode())
+    digest = digest.digest()
+
+    with _lock:
+        entry = _cache.get(id(data), {}).get(key)
+        if entry is not None and entry[0] == digest:
+            return entry[1]
+
+    value = compute(values)
+
+    with _lock:
+        if id(data) not in _cache:
+            # drop the entry with the array, before its id can be reused
+            weakref.finalize(data, _cache.pop, id(data), None)
+            _cache[id(data)] = {}
+        _cache[id(data)][key] = (digest, value)
+
+    return value
+
+def forget(data: np.ndarray):
+    """
+    Drop the cached statistics of an array to free their memory, they can't be stale (see cached).
+    """
+
+    with _lock:
+        entry = _cache.get(id(data))
+        if entry is not None:
+            entry.clear()
+
+def minmax(data: np.ndarray, sample_size: int=None, random: bool=False):
+    """
+    Minimum and maximum of data, NaN ignored.
+
+    Not cached, a single pass over the values costs about as much as checking a cached result.
+
+    params
+    ------
+    data: np.ndarray
+        Image data
+    sample_size: int, optional
+        Estimate from about this many values (see sample), default to None: every value, read in
+        a single pass for both
+    random: bool, optional
+        Sample at random positions instead of on a grid
+
+    return
+    ------
+    tuple(float, float)
+        Minimum and maximum value
+    """
+
+    values = np.asarray(data) if sample_size is None else sample(data, sample_size, random)
+
+    # cv2 reads the raw buffer in native byte order, FITS data is big-endian
+    if values.dtype == bool:
+        values = values.view(np.uint8)
+    elif not values.dtype.isnative:
+        values = values.astype(values.dtype.newbyteorder("="))
+
+    if values.ndim != 2:
+        values = values.reshape(values.shape[0], -1) if values.ndim > 2 else values.reshape(1, -1)
+
+    # cv2 finds both at once, comparisons with NaN fail so it only shows up when it is the first value
+    min_val, max_val = cv2.minMaxLoc(values)[:2]
+
+    if np.isnan(min_val) or np.isnan(max_val):
+        min_val, max_val = float(np.nanmin(values)), float(np.nanmax(values))
+
+    return min_val, max_val
+
+def percentile(data: np.ndarray, q, sample_size: int=DEFAULT_SAMPLE_SIZE, random: bool=False):
+    """
+    Percentiles of data, NaN ignored.
+
+    params
+    ------
+    data: np.ndarray
+        Image data
+    q: float | tuple(float, ...)
+        Percentile or percentiles to compute, 0 to 100
+    sample_size: int, optional
+        Estimate from about this many values (see sample), None for every value
+    random: bool, optional
+        Sample at random positions instead of on a grid
+
+    return
+    ------
+    float | tuple(float, ...)
+        Percentile, or one per value of q
+    """
+
+    def compute(values):
+        values = np.nanpercentile(values, q)
+        return float(values) if np.ndim(q) == 0 else tuple(float(value) for value in values)
+
+    return cached(data, ("percentile", tuple(np.atleast_1d(q).tolist()), sample_size, random), sample(data, sample_size, random), compute)
+
+def median(data: np.ndarray, sample_size: int=DEFAULT_SAMPLE_SIZE, random: bool=False):
+    """
+    Median of data, NaN ignored. See percentile for the parameters.
+    """
+
+    return cached(data, ("median", sample_size, random), sample(data, sample_size, random), lambda values: float(np.nanmedian(values)))
+
+def mad(data: np.ndarray, sample_size: int=DEFAULT_SAMPLE_SIZE, random: bool=False):
+    """
+    Median absolute deviation of data from its median, NaN ignored. See percentile for the parameters.
+
+    Multiplied by 1.4826 it estimates the standard deviation of normally distributed data,
+    without being thrown off by outliers (stars, hot pixels, cosmic rays).
+    """
+
+    def compute(values):
+        return float(np.nanmedian(np.abs(values - np.nanmedian(values))))
+
+    return cached(data, ("mad", sample_size, random), sample(data, sample_size, random), compute)